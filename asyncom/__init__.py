@@ -4,6 +4,7 @@
 from .om import OMDatabase  # noqa
 from .om import OMQuery  # noqa
 from .om import OMBase  # noqa
+from .routing import RoutedDatabase  # noqa
 
 
 __author__ = """Jordi Collell"""
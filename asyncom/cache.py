@@ -0,0 +1,351 @@
+"""Compiled statement cache.
+
+OMQuery statements are rebuilt on every call, but hot paths only use a
+handful of different shapes with different bound values. The cache keys
+a statement on its structure, keeps the bound values apart, and reuses
+the dialect compiled form on the next call with the same shape.
+"""
+
+import re
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy.sql.annotation import Annotated
+from sqlalchemy.sql.elements import ClauseElement, _anonymous_label
+from sqlalchemy.sql.selectable import Select
+from sqlalchemy.types import TypeEngine
+
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+_ANON_ID = re.compile(r"%\(\d+ ")
+_SIMPLE = (str, int, float, bool, type(None), type)
+
+
+class Uncacheable(Exception):
+    """The statement contains an element the cache key can not describe"""
+
+
+class StatementCache:
+    """Bounded LRU of compiled statements keyed on statement structure.
+
+    `maxsize=0` disables the cache.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize,
+                         len(self._entries))
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+    def get(self, statement, dialect):
+        """Returns the (cached) entry and an executable for statement.
+
+        The entry is None when the statement can not be cached.
+        """
+        if _renders_literals(statement, dialect):
+            compiled = statement.compile(dialect=dialect)
+            return None, BoundStatement(compiled, compiled.params)
+        try:
+            key, binds = statement_key(statement)
+            entry = self._entries.get(key)
+        except (Uncacheable, TypeError):
+            compiled = statement.compile(dialect=dialect)
+            return None, BoundStatement(compiled, compiled.params)
+
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry, entry.bind(binds)
+
+        self.misses += 1
+        compiled = statement.compile(dialect=dialect)
+        entry = CachedStatement.from_compiled(compiled, binds)
+        if entry is None:
+            return None, BoundStatement(compiled, compiled.params)
+        if self.maxsize:
+            self._entries[key] = entry
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry, entry.bind(binds)
+
+
+def _renders_literals(statement, dialect):
+    """Whether the compiler adds binds of its own to statement, which a
+    cached compiled form could not take: sqlite fills the OFFSET of a
+    LIMIT query (and the LIMIT of an OFFSET one) with a literal"""
+    return (
+        dialect.name == "sqlite" and isinstance(statement, Select) and
+        (statement._limit_clause is None) !=
+        (statement._offset_clause is None))
+
+
+class CachedStatement:
+    """A compiled statement plus what is needed to bind new values to it"""
+
+    __slots__ = ("compiled", "positions", "prefixes")
+
+    def __init__(self, compiled, positions):
+        self.compiled = compiled
+        # (bind name, index on the binds list) on compiled order
+        self.positions = positions
+        # column prefixes map, filled on demand by the mapper
+        self.prefixes = None
+
+    @classmethod
+    def from_compiled(cls, compiled, binds):
+        index = {id(bind): i for i, bind in enumerate(binds)}
+        positions = []
+        for bind, name in compiled.bind_names.items():
+            if id(bind) not in index:
+                # the compiler rendered a bind we have not seen while
+                # building the key, so its value can not be refreshed
+                return None
+            positions.append((name, index[id(bind)]))
+        return cls(compiled, tuple(positions))
+
+    def bind(self, binds):
+        params = {
+            name: binds[i].effective_value for name, i in self.positions
+        }
+        return BoundStatement(self.compiled, params, cached=True)
+
+
+class BoundStatement(ClauseElement):
+    """Executable that hands an already compiled statement to `databases`"""
+
+    __visit_name__ = "om_bound_statement"
+
+    # model of the query it comes from, for instrumentation events
+    entity = None
+    # writes rows without being an INSERT, UPDATE or DELETE itself, like
+    # a SELECT over INSERT ... RETURNING CTEs
+    writes = False
+
+    def __init__(self, compiled, params, cached=False):
+        self._compiled = BoundCompiled(compiled, params)
+        # comes from the statement cache, a shape worth preparing
+        self.cached = cached
+
+    def compile(self, bind=None, dialect=None, **kw):
+        return self._compiled
+
+    def __str__(self):
+        return self._compiled.string
+
+
+class BoundCompiled:
+    __slots__ = ("_compiled", "_params")
+
+    def __init__(self, compiled, params):
+        self._compiled = compiled
+        self._params = params
+
+    def __getattr__(self, name):
+        return getattr(self._compiled, name)
+
+    @property
+    def params(self):
+        return dict(self._params)
+
+    def construct_params(self, params=None, _group_number=None, _check=True):
+        return dict(self._params)
+
+
+def statement_key(statement):
+    """Returns a hashable key for the statement structure and the list
+    of its bind parameters, on a stable traversal order.
+
+    Raises Uncacheable for constructs it does not know how to describe.
+    """
+    visitor = _KeyVisitor()
+    key = visitor.key(statement)
+    return key, visitor.binds
+
+
+class _KeyVisitor:
+    def __init__(self):
+        self.binds = []
+        self._seen = {}
+
+    def key(self, elem):
+        if elem is None:
+            return None
+        if isinstance(elem, Annotated):
+            # annotated copies are rendered as the element they wrap
+            elem = elem._Annotated__element
+        ident = id(elem)
+        seen = self._seen.get(ident)
+        if seen is not None:
+            return ("ref", seen)
+        self._seen[ident] = len(self._seen)
+        fn = _DISPATCH.get(elem.__visit_name__)
+        if fn is None:
+            raise Uncacheable(elem.__visit_name__)
+        return fn(self, elem)
+
+    def keys(self, elems):
+        return tuple(self.key(e) for e in elems)
+
+    def visit_select(self, elem):
+        if elem._hints or elem._statement_hints:
+            raise Uncacheable("hints")
+        distinct = elem._distinct
+        if isinstance(distinct, list):
+            distinct = self.keys(distinct)
+        correlate_except = elem._correlate_except
+        if correlate_except is not None:
+            correlate_except = self.keys(correlate_except)
+        return (
+            "select",
+            self.keys(elem._raw_columns),
+            self.keys(elem._from_obj),
+            self.key(elem._whereclause),
+            self.key(elem._having),
+            self.key(elem._order_by_clause),
+            self.key(elem._group_by_clause),
+            self.key(elem._limit_clause),
+            self.key(elem._offset_clause),
+            distinct,
+            elem.use_labels,
+            self._for_update(elem._for_update_arg),
+            self.keys(elem._correlate),
+            correlate_except,
+            elem._auto_correlate,
+            tuple((self.key(p), d) for p, d in elem._prefixes),
+            tuple((self.key(s), d) for s, d in elem._suffixes),
+        )
+
+    def _for_update(self, arg):
+        if arg is None:
+            return None
+        of = self.keys(arg.of) if arg.of else None
+        return (arg.nowait, arg.read, arg.skip_locked, arg.key_share, of)
+
+    def visit_table(self, elem):
+        # schema objects are long lived, use them as they are
+        return ("table", elem)
+
+    def visit_alias(self, elem):
+        return ("alias", type(elem), _name(elem.name),
+                self.key(elem.element))
+
+    def visit_join(self, elem):
+        return ("join", self.key(elem.left), self.key(elem.right),
+                self.key(elem.onclause), elem.isouter, elem.full)
+
+    def visit_column(self, elem):
+        table = elem.table
+        if table is None:
+            return ("column", _name(elem.name), elem.is_literal,
+                    _type_key(elem.type))
+        return ("column", _name(elem.name), elem.is_literal,
+                self.key(table))
+
+    def visit_label(self, elem):
+        return ("label", _name(elem.name), self.key(elem.element),
+                _type_key(elem.type))
+
+    def visit_bindparam(self, elem):
+        if elem.required:
+            raise Uncacheable("required bindparam")
+        self.binds.append(elem)
+        if isinstance(elem.key, _anonymous_label):
+            key = ("anon", elem._orig_key)
+        else:
+            key = elem.key
+        return ("bind", key, elem.unique, elem.expanding,
+                _type_key(elem.type))
+
+    def visit_binary(self, elem):
+        return ("binary", type(elem), elem.operator, elem.negate,
+                self.key(elem.left), self.key(elem.right),
+                tuple(sorted(elem.modifiers.items())),
+                _type_key(elem.type))
+
+    def visit_clauselist(self, elem):
+        return ("clauselist", type(elem), elem.operator, elem.group,
+                elem.group_contents, self.keys(elem.clauses))
+
+    def visit_grouping(self, elem):
+        return ("grouping", type(elem), self.key(elem.element))
+
+    def visit_unary(self, elem):
+        return ("unary", type(elem), elem.operator, elem.modifier,
+                self.key(elem.element), _type_key(elem.type))
+
+    def visit_null(self, elem):
+        return ("null",)
+
+    def visit_true(self, elem):
+        return ("true",)
+
+    def visit_false(self, elem):
+        return ("false",)
+
+    def visit_textclause(self, elem):
+        binds = elem._bindparams
+        return ("text", elem.text,
+                tuple((k, self.key(binds[k])) for k in sorted(binds)))
+
+    def visit_function(self, elem):
+        return ("function", type(elem), elem.name, tuple(elem.packagenames),
+                self.key(elem.clause_expr), _type_key(elem.type))
+
+    def visit_cast(self, elem):
+        return ("cast", self.key(elem.clause), _type_key(elem.type))
+
+    def visit_type_coerce(self, elem):
+        return ("type_coerce", self.key(elem.clause), _type_key(elem.type))
+
+    def visit_typeclause(self, elem):
+        return ("typeclause", _type_key(elem.type))
+
+    def visit_case(self, elem):
+        return ("case", self.key(elem.value),
+                tuple((self.key(w), self.key(t)) for w, t in elem.whens),
+                self.key(elem.else_))
+
+    def visit_over(self, elem):
+        return ("over", self.key(elem.element), self.key(elem.partition_by),
+                self.key(elem.order_by), elem.range_, elem.rows)
+
+    def visit_label_reference(self, elem):
+        return ("label_reference", self.key(elem.element))
+
+    def visit_textual_label_reference(self, elem):
+        return ("textual_label_reference", elem.element)
+
+
+_DISPATCH = {
+    name[len("visit_"):]: fn
+    for name, fn in vars(_KeyVisitor).items() if name.startswith("visit_")
+}
+
+
+def _name(name):
+    if isinstance(name, _anonymous_label):
+        # anonymous names embed the id() of their element, and are
+        # rendered as anon_N on compile
+        return ("anon", _ANON_ID.sub("%(", name))
+    return (str(name), getattr(name, "quote", None))
+
+
+def _type_key(type_):
+    items = [type(type_)]
+    for k, v in sorted(vars(type_).items()):
+        if isinstance(v, _SIMPLE):
+            items.append((k, v))
+        elif isinstance(v, TypeEngine):
+            items.append((k, _type_key(v)))
+    return tuple(items)
@@ -0,0 +1,63 @@
+"""Identity map for request scoped work."""
+
+from sqlalchemy.orm.attributes import PASSIVE_OFF
+
+
+class IdentityMap:
+    """Instances by (mapper identity class, primary key).
+
+    Enabled with `OMDatabase.identity_map()`, while it's active get() and
+    get_many() are served from it, and query results hand back the
+    instance already mapped for a row instead of a new one.
+    """
+
+    def __init__(self):
+        self._objects = {}
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __contains__(self, ins):
+        key = identity_key(ins)
+        return key is not None and self._objects.get(key) is ins
+
+    def get(self, mapper, ident):
+        ins = self._objects.get(mapper.identity_key_from_primary_key(ident))
+        if ins is not None and isinstance(ins, mapper.class_):
+            return ins
+        return None
+
+    def add(self, ins):
+        """Registers ins, returning the instance already registered for
+        its primary key when there is one"""
+        key = identity_key(ins)
+        if key is None:
+            return ins
+        return self._objects.setdefault(key, ins)
+
+    def replace(self, ins):
+        key = identity_key(ins)
+        if key is not None:
+            self._objects[key] = ins
+
+    def discard(self, ins):
+        key = identity_key(ins)
+        if key is not None:
+            self._objects.pop(key, None)
+
+    def discard_class(self, cls):
+        for key in [k for k, v in self._objects.items() if isinstance(v, cls)]:
+            del self._objects[key]
+
+    def clear(self):
+        self._objects.clear()
+
+
+def identity_key(ins):
+    state = getattr(ins, "_sa_instance_state", None)
+    if state is None:
+        return None
+    key = state.mapper._identity_key_from_state(state, PASSIVE_OFF)
+    if any(value is None for value in key[1]):
+        return None
+    return key
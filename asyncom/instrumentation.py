@@ -0,0 +1,300 @@
+"""Instrumentation hooks for OMDatabase.
+
+Hooks get an Event before and after each phase of a statement:
+
+- compile: building the dialect SQL (a statement cache lookup for queries)
+- execute: the round trip to the database, until the rows are fetched
+- map: building instances (or records) from the rows
+
+    db = OMDatabase(url, hooks=[Aggregator(), SlowQueryLog(0.2)])
+    db.instrumentation.add(MyHook())
+
+A hook implements any of before_compile, after_compile, before_execute,
+after_execute, before_map and after_map, taking the event. Without hooks
+the only cost is a truth test per statement. With them, statements are
+compiled before they reach `databases` so compile and execute are timed
+apart, and each compiled statement is fingerprinted once.
+"""
+
+import hashlib
+import logging
+import time
+from collections import deque, namedtuple
+
+from sqlalchemy.sql.elements import ClauseElement
+
+from .cache import BoundStatement
+
+PHASES = ("compile", "execute", "map")
+
+Stats = namedtuple(
+    "Stats", ["phase", "fingerprint", "sql", "count", "total", "p50", "p99",
+              "max"])
+
+
+class Event:
+    """A phase of a statement. duration (seconds) and rows are set for
+    the after_ hooks, rows is None when the backend doesn't report it"""
+
+    __slots__ = ("phase", "fingerprint", "sql", "entity", "duration", "rows")
+
+    def __init__(self, phase, fingerprint=None, sql=None, entity=None):
+        self.phase = phase
+        self.fingerprint = fingerprint
+        self.sql = sql
+        self.entity = entity
+        self.duration = None
+        self.rows = None
+
+    def __repr__(self):
+        return (f"<Event {self.phase} {self.fingerprint} "
+                f"duration={self.duration} rows={self.rows}>")
+
+
+class Hook:
+    """Base class for hooks, every method is optional"""
+
+    def before_compile(self, event):
+        pass
+
+    def after_compile(self, event):
+        pass
+
+    def before_execute(self, event):
+        pass
+
+    def after_execute(self, event):
+        pass
+
+    def before_map(self, event):
+        pass
+
+    def after_map(self, event):
+        pass
+
+
+class Instrumentation:
+    """The hooks of a database, and the helpers timing each phase"""
+
+    def __init__(self, hooks=()):
+        self._hooks = []
+        # bound hook methods by event name
+        self._listeners = {}
+        for hook in hooks:
+            self.add(hook)
+
+    def __bool__(self):
+        return bool(self._hooks)
+
+    @property
+    def hooks(self):
+        return tuple(self._hooks)
+
+    def add(self, hook):
+        self._hooks.append(hook)
+        self._update()
+        return hook
+
+    def remove(self, hook):
+        self._hooks.remove(hook)
+        self._update()
+
+    def _update(self):
+        self._listeners = {
+            name: [
+                getattr(hook, name) for hook in self._hooks
+                # the no-op methods of Hook are not worth a call
+                if getattr(type(hook), name, None) not in (
+                    None, getattr(Hook, name))
+            ]
+            for name in (
+                f"{when}_{phase}"
+                for phase in PHASES for when in ("before", "after"))
+        }
+
+    def emit(self, name, event):
+        for listener in self._listeners[name]:
+            listener(event)
+
+    def compile(self, statement, dialect, cache=None, entity=None):
+        """Compiles statement (through cache when given) between the
+        compile hooks. Returns the cache entry and the executable."""
+        event = Event("compile", entity=entity)
+        self.emit("before_compile", event)
+        start = time.perf_counter()
+        if cache is None:
+            compiled = statement.compile(dialect=dialect)
+            entry, executable = None, BoundStatement(
+                compiled, compiled.params)
+        else:
+            entry, executable = cache.get(statement, dialect)
+        event.duration = time.perf_counter() - start
+        compiled = executable._compiled
+        event.fingerprint = fingerprint(compiled)
+        event.sql = compiled.string
+        executable.entity = entity
+        self.emit("after_compile", event)
+        return entry, executable
+
+    def prepare(self, query, values, dialect):
+        """Executable for query and the execute event it belongs to,
+        compiling statements the backend would compile"""
+        if (values is None and isinstance(query, ClauseElement) and
+                not isinstance(query, BoundStatement)):
+            _, query = self.compile(query, dialect)
+        if isinstance(query, BoundStatement):
+            compiled = query._compiled
+            return query, Event(
+                "execute", fingerprint(compiled), compiled.string,
+                getattr(query, "entity", None))
+        sql = str(query)
+        return query, Event("execute", fingerprint(sql), sql)
+
+    async def execute(self, fn, query, values, dialect, rows=None):
+        """Awaits fn(query, values) between the execute hooks, rows
+        counts the rows of the result"""
+        query, event = self.prepare(query, values, dialect)
+        self.emit("before_execute", event)
+        start = time.perf_counter()
+        result = await fn(query, values)
+        event.duration = time.perf_counter() - start
+        if rows is not None:
+            event.rows = rows(result)
+        self.emit("after_execute", event)
+        return result
+
+    async def iterate(self, fn, query, values, dialect, batches=False):
+        """Yields from fn(query, values) between the execute hooks. The
+        duration runs until the iteration ends, consumer time included,
+        rows are counted as they are yielded."""
+        query, event = self.prepare(query, values, dialect)
+        self.emit("before_execute", event)
+        event.rows = 0
+        start = time.perf_counter()
+        records = fn(query, values)
+        try:
+            async for record in records:
+                event.rows += len(record) if batches else 1
+                yield record
+        finally:
+            await records.aclose()
+            event.duration = time.perf_counter() - start
+            self.emit("after_execute", event)
+
+    def start_map(self, fingerprint=None, entity=None):
+        """Emits before_map and returns the event, the caller adds up
+        duration and rows and hands it to end_map"""
+        event = Event("map", fingerprint, entity=entity)
+        event.duration = 0.0
+        event.rows = 0
+        self.emit("before_map", event)
+        return event
+
+    def end_map(self, event):
+        self.emit("after_map", event)
+
+    def map(self, fn, rows, fingerprint=None, entity=None):
+        """Returns fn(rows) called between the map hooks"""
+        event = self.start_map(fingerprint, entity)
+        start = time.perf_counter()
+        result = fn(rows)
+        event.duration = time.perf_counter() - start
+        event.rows = len(result)
+        self.end_map(event)
+        return result
+
+
+def fingerprint(statement):
+    """Short hash of the SQL of a compiled statement (kept on it, the
+    compiled forms of the statement cache are hashed once) or of a SQL
+    string. Bound values are not part of it."""
+    if isinstance(statement, str):
+        return _hash(statement)
+    compiled = getattr(statement, "_compiled", statement)
+    value = getattr(compiled, "_asyncom_fingerprint", None)
+    if value is None:
+        value = compiled._asyncom_fingerprint = _hash(compiled.string)
+    return value
+
+
+def _hash(sql):
+    return hashlib.blake2b(sql.encode(), digest_size=8).hexdigest()
+
+
+class Aggregator(Hook):
+    """Keeps count, total and the last `samples` durations of each
+    fingerprint and phase, for p50/p99 figures"""
+
+    def __init__(self, phases=PHASES, samples=1000):
+        self.phases = frozenset(phases)
+        self.samples = samples
+        self._entries = {}
+
+    def after_compile(self, event):
+        self.record(event)
+
+    after_execute = after_map = after_compile
+
+    def record(self, event):
+        if event.phase not in self.phases:
+            return
+        key = (event.phase, event.fingerprint)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [
+                event.sql, 0, 0.0, deque(maxlen=self.samples)]
+        elif entry[0] is None:
+            entry[0] = event.sql
+        entry[1] += 1
+        entry[2] += event.duration
+        entry[3].append(event.duration)
+
+    def stats(self, phase=None):
+        """Stats of every fingerprint, slowest total first"""
+        res = []
+        # map events don't carry the SQL, the other phases do
+        sqls = {fp: sql for (_, fp), (sql, *_) in self._entries.items()
+                if sql is not None}
+        for (phase_, fp), (sql, count, total, samples) in \
+                self._entries.items():
+            if phase is not None and phase_ != phase:
+                continue
+            if sql is None:
+                sql = sqls.get(fp)
+            ordered = sorted(samples)
+            res.append(Stats(
+                phase_, fp, sql, count, total, percentile(ordered, 50),
+                percentile(ordered, 99), ordered[-1]))
+        res.sort(key=lambda stat: stat.total, reverse=True)
+        return res
+
+    def reset(self):
+        self._entries.clear()
+
+
+def percentile(ordered, pct):
+    """Nearest rank percentile of a sorted list"""
+    if not ordered:
+        return None
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+class SlowQueryLog(Hook):
+    """Logs statements whose execute phase takes threshold seconds or
+    more. Recent ones are kept on `entries`."""
+
+    def __init__(self, threshold=1.0, logger=None, keep=100):
+        self.threshold = threshold
+        self.logger = logger or logging.getLogger("asyncom.slow")
+        self.entries = deque(maxlen=keep)
+
+    def after_execute(self, event):
+        if event.duration < self.threshold:
+            return
+        self.entries.append(event)
+        entity = getattr(event.entity, "__name__", event.entity)
+        self.logger.warning(
+            "slow query %.3fs rows=%s entity=%s fingerprint=%s: %s",
+            event.duration, event.rows, entity, event.fingerprint,
+            event.sql)
@@ -0,0 +1,63 @@
+"""DataLoader style batching of primary key lookups."""
+
+import asyncio
+import contextvars
+
+
+class DataLoader:
+    """Coalesces the get() calls made on the same event loop iteration
+    into a single OMQuery.get_many() query.
+
+        loader = db.loader(Model)
+        a, b = await asyncio.gather(loader.get(1), loader.get(2))
+
+    Only callers that share a connection and identity map share a batch,
+    which runs in the context of the first of them, so a task never gets
+    rows through the transaction of another one.
+    """
+
+    def __init__(self, database, entity, chunk_size=1000):
+        self.database = database
+        self.entity = entity
+        self.chunk_size = chunk_size
+        # (context, [(ident, future)]) by caller connection and identity map
+        self._queues = {}
+
+    def get(self, ident):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self._queues:
+            loop.call_soon(self._dispatch)
+        key = self._context_key()
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = (contextvars.copy_context(), [])
+        queue[1].append((ident, future))
+        return future
+
+    async def get_many(self, idents):
+        return await asyncio.gather(*[self.get(ident) for ident in idents])
+
+    def _context_key(self):
+        database = self.database
+        # the copied context keeps both alive until the batch is sent
+        return (id(database.connection()),
+                id(database.get_identity_map()))
+
+    def _dispatch(self):
+        queues, self._queues = self._queues, {}
+        for context, queue in queues.values():
+            context.run(asyncio.ensure_future, self._load(queue))
+
+    async def _load(self, queue):
+        try:
+            results = await self.database.query(self.entity).get_many(
+                [ident for ident, _ in queue], chunk_size=self.chunk_size)
+        except Exception as exc:
+            for _, future in queue:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        for (_, future), result in zip(queue, results):
+            if not future.done():
+                future.set_result(result)
@@ -2,13 +2,50 @@
 """Main module."""
 
 
-from collections.abc import Iterable
+import asyncio
+import copy
+import json
+import time
+from collections import namedtuple
+from collections.abc import Iterable, Mapping
+from contextvars import ContextVar
+from functools import lru_cache
+from inspect import CORO_CREATED, getcoroutinestate
+from operator import itemgetter
 
-from sqlalchemy import inspect, sql
-from sqlalchemy.orm import Query
+from sqlalchemy import Table, inspect, orm, sql
+from sqlalchemy import exc as sa_exc
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.ext.declarative.base import _declarative_constructor
+from sqlalchemy.orm import Mapper, Query
 from sqlalchemy.orm import exc as orm_exc
+from sqlalchemy.orm.attributes import (
+    NEVER_SET, NO_VALUE, PASSIVE_NO_RESULT, SQL_OK, instance_state,
+    set_committed_value)
+from sqlalchemy.orm.mapper import _event_on_init
+from sqlalchemy.sql.base import Executable
+from sqlalchemy.sql.elements import ClauseElement
+from sqlalchemy.sql.expression import FromClause
 
 from databases import Database
+from databases.core import Connection
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .cache import BoundStatement, StatementCache
+from .identity import IdentityMap
+from .instrumentation import Instrumentation, fingerprint
+from .loader import DataLoader
+from .prepared import PostgresStatement, PreparedStatements
+from .plans import (
+    check_dict_keys, inherited_pairs, mapper_plan, returned_columns,
+    table_plan)
+from .records import record_mapper
 
 from typing import TypeVar, Generic, Optional, List, Type, AsyncIterator, Union, Any
 
@@ -17,22 +54,297 @@ T = TypeVar("T")
 
 def default_mapper_factory(query, context):
     entity = query._entity_zero()
-    prefixes = get_prefixes(context.statement._columns_plus_names)
+    names = tuple(query.get_prefixes(context).values())
+    if query._readonly and isinstance(entity, Mapper):
+        return record_mapper(entity, names)
+    fn = row_mapper(entity, names)
+    if query._unloaded is None or not isinstance(entity, Mapper):
+        return fn
+    callables = unloaded_callables(
+        entity, names, query._unloaded, query._database)
+    if not callables:
+        return fn
+
+    def map_result(row):
+        ins = fn(row)
+        instance_state(ins).callables = dict(callables)
+        return ins
+    return map_result
+
+
+@lru_cache(maxsize=512)
+def row_mapper(entity, names):
+    """Builds the row to instance function for an entity and a column
+    layout, `names` being the attribute for each row position.
+
+    When the model keeps the declarative constructor, instances are
+    created without calling it and row values go straight to their dict.
+    """
+    values = row_values(len(names))
+    mutable = ()
+    if isinstance(entity, Mapper):
+        mutable = tuple(
+            key for key in mapper_plan(entity).mutable if key in names)
+
+    if not _can_skip_init(entity, names):
+        cls = entity.entity
 
-    def map_result(v):
-        return entity.entity(
-            **{prefixes[k]: v for k, v in dict(v).items()})
+        def map_result(row):
+            ins = cls(**dict(zip(names, values(row))))
+            # loaded values are the reference for changes
+            state = instance_state(ins)
+            state._commit_all(state.dict)
+            if mutable:
+                snapshot_mutable(state, mutable)
+            return ins
+        return map_result
+
+    new_instance = entity.class_manager.new_instance
+    if mutable:
+        def map_result(row):
+            ins = new_instance()
+            ins.__dict__.update(zip(names, values(row)))
+            snapshot_mutable(instance_state(ins), mutable)
+            return ins
+        return map_result
+
+    def map_result(row):
+        ins = new_instance()
+        ins.__dict__.update(zip(names, values(row)))
+        return ins
     return map_result
 
 
+def row_values(size):
+    """Function returning the first size values of a row as a tuple"""
+    if size == 1:
+        def values(row):
+            return (row[0],)
+        return values
+    return itemgetter(*range(size))
+
+
+def _can_skip_init(entity, names):
+    if not isinstance(entity, Mapper):
+        return False
+    manager = entity.class_manager
+    init = getattr(manager.original_init, "_sa_original_init",
+                   manager.original_init)
+    if init is not _declarative_constructor:
+        return False
+    if any(fn is not _event_on_init for fn in manager.dispatch.init):
+        return False
+    if entity._set_polymorphic_identity or entity.validators:
+        return False
+    for name in names:
+        if name not in entity.column_attrs or manager[name].dispatch.set:
+            return False
+    return True
+
+
+class UnloadedAttributeError(sa_exc.InvalidRequestError):
+    """An attribute left out by only() or defer() was accessed"""
+
+
+class DeferredValue:
+    """Stands for an attribute left out by a query with unloaded="lazy",
+    awaiting it fetches the value and sets it on the instance"""
+
+    __slots__ = ("_database", "_instance", "_key")
+
+    def __init__(self, database, instance, key):
+        self._database = database
+        self._instance = instance
+        self._key = key
+
+    def __await__(self):
+        return self._load().__await__()
+
+    async def _load(self):
+        await self._database.load(self._instance, self._key)
+        return getattr(self._instance, self._key)
+
+    def __repr__(self):
+        return f"<DeferredValue {self._key}>"
+
+
+Prefetch = namedtuple(
+    "Prefetch", ["attr", "query", "column", "many", "key", "child_key"])
+
+
+def _find_foreign_key(mapper, child):
+    found = [
+        fk.parent for table in child.tables for fk in table.foreign_keys
+        if fk.column.table in mapper.tables
+    ] + [
+        fk.parent for table in mapper.tables for fk in table.foreign_keys
+        if fk.column.table in child.tables
+    ]
+    if len(found) != 1:
+        raise ValueError(
+            f"Can't find a single foreign key between {mapper} and {child}, "
+            f"pass it with fk")
+    return found[0]
+
+
+def unloaded_callables(mapper, names, unloaded, database):
+    """Attribute loaders for the column attributes of mapper not in names"""
+    callables = {}
+    for prop in mapper.column_attrs:
+        if prop.key not in names:
+            callables[prop.key] = _unloaded_callable(
+                mapper, prop.key, unloaded, database)
+    return callables
+
+
+def _unloaded_callable(mapper, key, unloaded, database):
+    def load(state, passive):
+        if not passive & SQL_OK:
+            return PASSIVE_NO_RESULT
+        if unloaded == "lazy":
+            return DeferredValue(database, state.obj(), key)
+        raise UnloadedAttributeError(
+            f"{mapper.class_.__name__}.{key} was not loaded by the query, "
+            f"fetch it with `await db.load(instance)`")
+    return load
+
+
+def is_unloaded(state, key):
+    return (key in state.callables or key not in state.dict or
+            isinstance(state.dict[key], DeferredValue))
+
+
 class OMQuery(Query, Generic[T]):
     def __init__(self, entity: T, database=None,
-                 mapper_factory=default_mapper_factory):
+                 mapper_factory=default_mapper_factory, cache=True):
         self.__db = database
         self._all = None
         self._mapper_factory = mapper_factory
+        self._use_cache = cache
+        # how attributes left out by only() or defer() behave
+        self._unloaded = None
+        self._readonly = False
+        self._prefetch = ()
         super().__init__([entity], session=None)
 
+    @property
+    def _database(self):
+        return self.__db
+
+    def no_cache(self) -> "OMQuery[T]":
+        """Don't go through the database statement cache for this query"""
+        q = self._clone()
+        q._use_cache = False
+        return q
+
+    def readonly(self) -> "OMQuery[T]":
+        """Returns rows as read only records instead of mapped instances.
+
+        Records are instances of a `__slots__` class generated per model
+        with its column attributes and plain properties, they take less
+        memory and are faster to build, but can't be updated or removed.
+        They are not registered on the identity map.
+        """
+        q = self._clone()
+        q._readonly = True
+        return q
+
+    def only(self, *cols, unloaded="raise") -> "OMQuery[T]":
+        """Selects only cols (attributes or their names) and the primary
+        key, building partially loaded instances.
+
+        Accessing an attribute that wasn't loaded raises
+        UnloadedAttributeError, or with `unloaded="lazy"` returns a
+        DeferredValue, `await ins.attr` fetches it. `await db.load(ins)`
+        fetches all of them.
+        Partial instances are not registered on the identity map.
+        """
+        return self._partial(orm.load_only(*cols), unloaded)
+
+    def defer(self, *cols, unloaded="raise") -> "OMQuery[T]":
+        """Leaves cols out of the select, see only()"""
+        return self._partial([orm.defer(col) for col in cols], unloaded)
+
+    def _partial(self, options, unloaded):
+        if unloaded not in ("raise", "lazy"):
+            raise ValueError(f"unloaded must be raise or lazy, not {unloaded}")
+        if not isinstance(options, list):
+            options = [options]
+        q = self.options(*options)
+        q._unloaded = unloaded
+        return q
+
+    def prefetch(self, child_model, *, attr, fk=None,
+                 query=None) -> "OMQuery[T]":
+        """Loads the child_model rows related to the results with one
+        batched IN query, and sets them on the `attr` attribute of every
+        result.
+
+        `fk` is the (single column) foreign key linking both models, found
+        from the table foreign keys when not given. When it's on the child
+        table each result gets the list of its children, when it's on the
+        queried table, the referenced child or None. `query` is the child
+        query to use, to filter, order or prefetch from it.
+
+        Applies to all() and what is built on it (one, get, get_many,
+        iter_chunks), not to cursor iteration.
+        """
+        mapper = self._only_full_mapper_zero("prefetch")
+        if attr in mapper.attrs or isinstance(
+                getattr(mapper.class_, attr, None), property):
+            raise ValueError(f"{attr} is already an attribute of {mapper}")
+        child = inspect(child_model)
+        if fk is None:
+            fk = _find_foreign_key(mapper, child)
+        if hasattr(fk, "__clause_element__"):
+            fk = fk.__clause_element__()
+        if len(fk.foreign_keys) != 1:
+            raise ValueError(f"{fk} is not a foreign key")
+        ref = next(iter(fk.foreign_keys)).column
+        if fk.table in child.tables:
+            # one to many, fk on the child
+            relation = Prefetch(
+                attr, query or self.__db.query(child_model), fk, True,
+                mapper.get_property_by_column(ref).key,
+                child.get_property_by_column(fk).key)
+        elif fk.table in mapper.tables:
+            relation = Prefetch(
+                attr, query or self.__db.query(child_model), ref, False,
+                mapper.get_property_by_column(fk).key,
+                child.get_property_by_column(ref).key)
+        else:
+            raise ValueError(f"{fk} doesn't link {mapper} and {child}")
+        q = self._clone()
+        q._prefetch = self._prefetch + (relation,)
+        return q
+
+    async def _load_prefetched(self, instances):
+        for relation in self._prefetch:
+            values = list(dict.fromkeys(
+                value for value in (
+                    getattr(ins, relation.key) for ins in instances)
+                if value is not None))
+            query = relation.query
+            if relation.many:
+                query = query.order_by(
+                    *inspect(relation.column.table).primary_key)
+            related = {}
+            for i in range(0, len(values), 1000):
+                chunk = [(value,) for value in values[i:i + 1000]]
+                rows = await query.filter(
+                    query._pk_in([relation.column], chunk)).all()
+                for row in rows:
+                    value = getattr(row, relation.child_key)
+                    if relation.many:
+                        related.setdefault(value, []).append(row)
+                    else:
+                        related[value] = row
+            for ins in instances:
+                value = related.get(getattr(ins, relation.key))
+                if relation.many:
+                    value = list(value or ())
+                setattr(ins, relation.attr, value)
+
     async def all(self) -> List[T]:
         context = self._compile_context()
         context.statement.use_labels = True
@@ -41,7 +353,49 @@ class OMQuery(Query, Generic[T]):
     async def get(self, ident: Any) -> Optional[T]:
         mapper = self._only_full_mapper_zero("get")
         pk = mapper.primary_key
-        return await self.filter(pk[0] == ident).one_or_none()
+        identity_map = self._identity_map()
+        if identity_map is not None and self._criterion is None:
+            ins = identity_map.get(
+                mapper, (ident,) if len(pk) == 1 else tuple(ident))
+            if ins is not None:
+                return ins
+        if len(pk) == 1:
+            return await self.filter(pk[0] == ident).one_or_none()
+        return await self.filter(
+            *[col == val for col, val in zip(pk, ident)]).one_or_none()
+
+    async def get_many(self, idents, chunk_size=1000) -> List[Optional[T]]:
+        """Loads instances by primary key with one query per chunk of
+        chunk_size keys.
+
+        Results follow the order of idents, with None for the missing
+        ones. Composite primary keys are given as tuples.
+        """
+        mapper = self._only_full_mapper_zero("get_many")
+        pk = mapper.primary_key
+        pk_keys = [mapper.get_property_by_column(c).key for c in pk]
+        if len(pk) == 1:
+            keys = [(ident,) for ident in idents]
+        else:
+            keys = [tuple(ident) for ident in idents]
+
+        found = {}
+        unique = list(dict.fromkeys(keys))
+        identity_map = self._identity_map()
+        if identity_map is not None and self._criterion is None:
+            for key in unique:
+                ins = identity_map.get(mapper, key)
+                if ins is not None:
+                    found[key] = ins
+            unique = [key for key in unique if key not in found]
+        for i in range(0, len(unique), chunk_size):
+            chunk = unique[i:i + chunk_size]
+            for ins in await self.filter(self._pk_in(pk, chunk)).all():
+                found[tuple(getattr(ins, k) for k in pk_keys)] = ins
+        return [found.get(key) for key in keys]
+
+    def _pk_in(self, pk, keys):
+        return pk_in(pk, keys, self.__db.dialect)
 
     async def one_or_none(self) -> Optional[T]:
         ret = await self.all()
@@ -70,46 +424,379 @@ class OMQuery(Query, Generic[T]):
                 raise orm_exc.NoResultFound("No row was found for one()")
         return ret
 
-    async def count(self) -> Optional[int]:
+    async def count(self, estimate=False) -> Optional[int]:
+        """Number of rows the query returns.
+
+        Counts with `SELECT count(*) FROM <froms> WHERE ...`, only
+        DISTINCT, GROUP BY, HAVING, LIMIT and OFFSET queries are counted
+        over a subquery. With estimate, the row count the postgres planner
+        expects for the query is returned instead, which doesn't scan the
+        table but may be far off; other databases count exactly.
+        """
+        if estimate and self.__db.dialect.name == "postgresql":
+            return await self._estimate_count()
         col = sql.func.count(sql.literal_column("*"))
-        return await self.from_self(col).scalar()
+        if (self._distinct or self._group_by or self._having is not None or
+                self._limit is not None or self._offset is not None):
+            return await self.from_self(col).scalar()
+        statement = self._compile_context().statement
+        if not isinstance(statement, sql.Select):
+            return await self.from_self(col).scalar()
+        froms = statement.froms
+        statement = statement.with_only_columns([col]).order_by(None)
+        for from_ in froms:
+            # entity tables are only referenced from the replaced columns
+            statement = statement.select_from(from_)
+        _, statement = self._cached(statement)
+        return await self._reader().fetch_val(statement)
+
+    async def _estimate_count(self) -> int:
+        context = self._compile_context()
+        context.statement.use_labels = True
+        plan = await self._reader().fetch_val(Explain(context.statement))
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
 
     async def scalar(self) -> Optional[int]:
         context = self._compile_context()
         context.statement.use_labels = True
         try:
-            ret = await self.__db.fetch_val(context.statement)
+            ret = await self._reader().fetch_val(self._executable(context))
             if not isinstance(ret, Iterable):
                 return ret
             return ret[0]  # type: ignore
         except orm_exc.NoResultFound:
             return None
 
-    async def iterate(self) -> AsyncIterator[T]:
+    async def iterate(self, batch_size=None, buffer=0) -> AsyncIterator[T]:
+        """Yields instances from a cursor. With batch_size rows are
+        fetched and mapped batch_size at a time, see iterate_batches"""
+        if batch_size is not None:
+            async for batch in self.iterate_batches(batch_size, buffer):
+                for ins in batch:
+                    yield ins
+            return
+        self._check_cursor()
         context = self._compile_context()
         context.statement.use_labels = True
+        statement = self._executable(context)
         fn = self.get_mapper(context)
-        async for row in self.__db.iterate(context.statement):
-            yield fn(row)  # type: ignore
+        identity_map = self._identity_map()
+        instrumentation = self._instrumentation()
+        if instrumentation:
+            # one map event for the whole cursor
+            event = instrumentation.start_map(
+                context.statement._asyncom_fingerprint, self._event_entity())
+            fn = timed(fn, event)
+        try:
+            async for row in self._reader().iterate(statement):
+                ins = fn(row)
+                if identity_map is not None:
+                    ins = identity_map.add(ins)
+                yield ins  # type: ignore
+        finally:
+            if instrumentation:
+                instrumentation.end_map(event)
+
+    async def iterate_batches(self, batch_size=1000,
+                              buffer=1) -> AsyncIterator[List[T]]:
+        """Yields lists of up to batch_size instances, fetching batch_size
+        rows per round trip and mapping each batch in one go.
+
+        Up to `buffer` batches are fetched and mapped ahead of the
+        consumer, the fetch waits when they are not consumed, so a slow
+        consumer doesn't make memory grow. `buffer=0` only fetches when
+        the next batch is asked for.
+        """
+        self._check_cursor()
+        context = self._compile_context()
+        context.statement.use_labels = True
+        statement = self._executable(context)
+        batches = self._map_batches(
+            self._reader().iterate_batches(statement, batch_size=batch_size),
+            context)
+        if buffer:
+            batches = read_ahead(batches, buffer)
+        try:
+            async for batch in batches:
+                yield batch
+        finally:
+            await batches.aclose()
+
+    def _check_cursor(self):
+        if self._prefetch:
+            # the cursor holds the connection prefetch queries would need
+            raise sa_exc.InvalidRequestError(
+                "prefetch() is not supported while iterating a cursor, "
+                "use iter_chunks()")
+
+    async def _map_batches(self, batches, context):
+        try:
+            async for records in batches:
+                yield self.map_to_instances(records, context)
+        finally:
+            # release the cursor when the consumer stops early
+            await batches.aclose()
+
+    async def iter_chunks(self, chunk_size=1000, key=None,
+                          after=None) -> AsyncIterator[List[T]]:
+        """Yields lists of up to chunk_size instances, paging with keyset
+        conditions (`WHERE key > last ORDER BY key LIMIT n`).
+
+        `key` are the columns to page on, the primary key by default, and
+        they must be unique and not null. Every chunk is a query of its
+        own, no cursor or transaction is held between them, and `after`
+        (the key values of the last seen row) resumes a scan.
+
+        Chunks are limited queries themselves, so it can't be used on a
+        query with limit() or offset().
+        """
+        if self._limit is not None or self._offset is not None:
+            raise sa_exc.InvalidRequestError(
+                "iter_chunks() keyset paging can't wrap a query with "
+                "limit() or offset()")
+        mapper = self._only_full_mapper_zero("iter_chunks")
+        if key is None:
+            columns = list(mapper.primary_key)
+        elif isinstance(key, (list, tuple)):
+            columns = list(key)
+        else:
+            columns = [key]
+        attrs = [_attribute_key(mapper, col) for col in columns]
+        base = self.order_by(None)
+        last = None
+        if after is not None:
+            last = list(after) if len(columns) > 1 else [after]
+        while True:
+            query = base
+            if last is not None:
+                if len(columns) == 1:
+                    query = query.filter(columns[0] > last[0])
+                else:
+                    query = query.filter(
+                        sql.tuple_(*columns) > sql.tuple_(*last))
+            chunk = await query.order_by(*columns).limit(chunk_size).all()
+            if not chunk:
+                return
+            yield chunk
+            if len(chunk) < chunk_size:
+                return
+            last = [getattr(chunk[-1], attr) for attr in attrs]
+
+    async def tuples(self) -> List[tuple]:
+        """Rows as tuples, without building instances"""
+        names, rows = await self._fetch_rows()
+        values = row_values(len(names))
+        return [values(row) for row in rows]
+
+    async def dicts(self) -> List[dict]:
+        """Rows as dicts keyed by attribute name, without building
+        instances"""
+        names, rows = await self._fetch_rows()
+        values = row_values(len(names))
+        return [dict(zip(names, values(row))) for row in rows]
+
+    async def columns(self, arrays=None) -> dict:
+        """Column oriented result, {attribute name: values}.
+
+        Values are NumPy arrays when `arrays`, by default when NumPy is
+        installed, and lists otherwise.
+        """
+        if arrays is None:
+            arrays = numpy is not None
+        elif arrays and numpy is None:
+            raise ImportError("columns(arrays=True) needs numpy installed")
+        names, rows = await self._fetch_rows()
+        values = row_values(len(names))
+        data = list(zip(*[values(row) for row in rows])) or [()] * len(names)
+        if arrays:
+            return {name: numpy.array(col) for name, col in zip(names, data)}
+        return {name: list(col) for name, col in zip(names, data)}
+
+    async def _fetch_rows(self):
+        context = self._compile_context()
+        context.statement.use_labels = True
+        rows = await self._reader().fetch_all(self._executable(context))
+        return tuple(self.get_prefixes(context).values()), rows
 
     async def _execute(self, context) -> List[T]:
-        result = await self.__db.fetch_all(context.statement)
-        return self.map_to_instances(result, context)
+        result = await self._reader().fetch_all(self._executable(context))
+        instances = self.map_to_instances(result, context)
+        if self._prefetch:
+            if self._readonly:
+                raise sa_exc.InvalidRequestError(
+                    "prefetch() can't set attributes on readonly() records")
+            await self._load_prefetched(instances)
+        return instances
+
+    def _executable(self, context):
+        """Returns the executable for context.statement, compiled through
+        the database statement cache when it's enabled"""
+        entry, statement = self._cached(context.statement)
+        # QueryContext has slots, keep the entry with its statement
+        context.statement._asyncom_entry = entry
+        context.statement._asyncom_fingerprint = (
+            fingerprint(statement._compiled)
+            if isinstance(statement, BoundStatement) else None)
+        return statement
+
+    def _cached(self, statement):
+        cache = getattr(self.__db, "statement_cache", None)
+        if not self._use_cache:
+            cache = None
+        instrumentation = self._instrumentation()
+        if instrumentation:
+            return instrumentation.compile(
+                statement, self.__db.dialect, cache, self._event_entity())
+        if cache is None:
+            return None, statement
+        return cache.get(statement, self.__db.dialect)
+
+    def _reader(self):
+        """Database the query reads from, a replica with RoutedDatabase"""
+        reader = getattr(self.__db, "reader", None)
+        return self.__db if reader is None else reader()
+
+    def _instrumentation(self):
+        return getattr(self.__db, "instrumentation", None)
+
+    def _event_entity(self):
+        entity = self._entity_zero()
+        return getattr(entity, "class_", entity)
+
+    def get_prefixes(self, context):
+        entry = getattr(context.statement, "_asyncom_entry", None)
+        if entry is None:
+            return get_prefixes(context.statement._columns_plus_names)
+        if entry.prefixes is None:
+            entry.prefixes = get_prefixes(
+                context.statement._columns_plus_names)
+        return entry.prefixes
 
     def get_mapper(self, context) -> Type[T]:
         return self._mapper_factory(self, context)
 
     def map_to_instances(self, result, context) -> List[T]:
+        instrumentation = self._instrumentation()
+        if instrumentation:
+            return instrumentation.map(
+                lambda rows: self._map_rows(rows, context), result,
+                getattr(context.statement, "_asyncom_fingerprint", None),
+                self._event_entity())
+        return self._map_rows(result, context)
+
+    def _map_rows(self, result, context) -> List[T]:
         fn = self.get_mapper(context)
+        identity_map = self._identity_map()
+        if identity_map is not None:
+            return [identity_map.add(fn(r)) for r in result]
         return [fn(r) for r in result]  # type: ignore
 
+    def _identity_map(self):
+        if self.__db is None or not hasattr(self.__db, "get_identity_map"):
+            return None
+        if self._unloaded is not None or self._readonly:
+            return None
+        return self.__db.get_identity_map()
+
+    async def update(self, values, chunk_size=1000):
+        """Set based UPDATE of the rows matching the query.
+
+        `values` maps attributes (or their names) to values or sql
+        expressions. Column onupdate defaults are applied. On joined
+        inheritance every table with values is updated through a
+        primary key subquery, or when several tables are, through the
+        primary keys selected up front, so updating a column of the
+        filter doesn't leave the later tables without matches.
+        """
+        mapper = self._only_full_mapper_zero("update")
+        context = self._compile_context()
+        by_table = {}
+        for key, value in values.items():
+            column = _mapper_column(mapper, key)
+            by_table.setdefault(column.table, {})[column.name] = value
+        attrs = {
+            table: [mapper.get_property_by_column(col).key
+                    for col in table.primary_key.columns]
+            for table in by_table
+        }
+        async with self.__db.transaction():
+            rows = None
+            if len(mapper.tables) > 1 and len(by_table) > 1:
+                names = list(dict.fromkeys(
+                    key for keys in attrs.values() for key in keys))
+                rows = await self.__db.fetch_all(
+                    self._pk_select(mapper, context, names))
+                if not rows:
+                    return
+            for table, table_values in by_table.items():
+                table_values.update(onupdate_values(table, table_values))
+                expr = table.update().values(table_values)
+                pk = list(table.primary_key.columns)
+                if len(mapper.tables) == 1:
+                    if context.whereclause is not None:
+                        expr = expr.where(context.whereclause)
+                elif rows is None:
+                    keys = self._pk_select(mapper, context, attrs[table])
+                    expr = expr.where(sql.tuple_(*pk).in_(keys)
+                                      if len(pk) > 1 else pk[0].in_(keys))
+                else:
+                    keys = list(dict.fromkeys(
+                        tuple(row[key] for key in attrs[table])
+                        for row in rows))
+                    for i in range(0, len(keys), chunk_size):
+                        await self.__db.execute(expr.where(pk_in(
+                            pk, keys[i:i + chunk_size], self.__db.dialect)))
+                    continue
+                await self.__db.execute(expr)
+        identity_map = self._identity_map()
+        if identity_map is not None:
+            identity_map.discard_class(mapper.class_)
+
+    def _pk_select(self, mapper, context, attrs):
+        keys = sql.select([mapper.columns[key].label(key) for key in attrs])
+        for from_ in context.statement.froms:
+            keys = keys.select_from(from_)
+        if context.whereclause is not None:
+            keys = keys.where(context.whereclause)
+        return keys
+
     async def delete(self):
         context = self._compile_context()
         entity = self._entity_zero().entity
         op = sql.delete(entity.__table__, context.whereclause)
+        identity_map = self._identity_map()
+        if identity_map is not None:
+            identity_map.discard_class(entity)
         return await self.__db.execute(op)
 
 
+def pk_in(pk, keys, dialect):
+    """Condition matching the pk columns against a list of key tuples"""
+    postgres = dialect.name == "postgresql"
+    if len(pk) == 1:
+        values = [key[0] for key in keys]
+        if postgres:
+            # a single array parameter keeps one statement shape
+            return pk[0] == sql.any_(sql.bindparam(
+                None, values, type_=ARRAY(pk[0].type)))
+        return pk[0].in_(values)
+    if postgres:
+        return sql.tuple_(*pk).in_(keys)
+    return sql.or_(*[
+        sql.and_(*[col == val for col, val in zip(pk, key)])
+        for key in keys
+    ])
+
+
+def _attribute_key(mapper, col):
+    if hasattr(col, "property"):
+        # instrumented attribute, Model.id
+        return col.key
+    return mapper.get_property_by_column(col).key
+
+
 def get_prefixes(cols):
     res = {}
     for key, col in cols:
@@ -124,10 +811,221 @@ def get_prefixes(cols):
 
 class OMDatabase(Database):
 
+    def __init__(self, url, *, statement_cache_size=256, hooks=(),
+                 prepared_statements=0, **options):
+        super().__init__(url, **options)
+        self.statement_cache = StatementCache(statement_cache_size)
+        # see asyncom.prepared, off unless a size is given
+        self.prepared_statements = PreparedStatements(prepared_statements)
+        # see asyncom.instrumentation
+        self.instrumentation = Instrumentation(hooks)
+        self._loaders = {}
+        self._identity_map_var = ContextVar(
+            f"asyncom_identity_map_{id(self)}", default=None)
+
     def query(self, entity: T,
-              mapper_factory=default_mapper_factory) -> OMQuery[T]:
+              mapper_factory=default_mapper_factory,
+              cache=True) -> OMQuery[T]:
         return OMQuery(entity, database=self,
-                       mapper_factory=mapper_factory)
+                       mapper_factory=mapper_factory, cache=cache)
+
+    @property
+    def dialect(self):
+        return self._backend._dialect
+
+    def loader(self, entity) -> DataLoader:
+        """Shared DataLoader for entity, batching concurrent gets"""
+        loader = self._loaders.get(entity)
+        if loader is None:
+            loader = self._loaders[entity] = DataLoader(self, entity)
+        return loader
+
+    def identity_map(self):
+        """Context manager scoping an IdentityMap to the current task
+        (and the tasks it starts). Nested uses share the outer map."""
+        return _IdentityMapScope(self._identity_map_var)
+
+    def session(self, batch_size=500):
+        """Unit of work queueing add, update and remove calls, flushed
+        with batched statements in one transaction on flush() or when
+        the `async with` block exits without error. See Session"""
+        from .session import Session
+        return Session(self, batch_size=batch_size)
+
+    def get_identity_map(self) -> Optional[IdentityMap]:
+        return self._identity_map_var.get()
+
+    def reader(self):
+        """Database OMQuery reads go to, see RoutedDatabase"""
+        return self
+
+    def in_transaction(self):
+        """Whether the current task runs inside a transaction, or on the
+        force_rollback connection"""
+        if self._global_connection is not None:
+            return True
+        connection = self._connection_context.get(None)
+        return connection is not None and bool(connection._transaction_stack)
+
+    async def gather(self, *queries, max_concurrency=None):
+        """Runs independent queries concurrently, each on a pooled
+        connection of its own, and returns their results in order.
+
+        `queries` are OMQuery calls not awaited yet (`q.count()`,
+        `q.get(1)`...) or OMQuery instances, run with all(). At most
+        max_concurrency of them run at once. Inside a transaction or with
+        force_rollback they run one after the other, on the connection
+        holding it.
+        """
+        awaitables = [
+            q.all() if isinstance(q, OMQuery) else q for q in queries]
+        if max_concurrency == 1 or self.in_transaction():
+            results = []
+            try:
+                for aw in awaitables:
+                    results.append(await aw)
+            finally:
+                _close_pending(awaitables)
+            return results
+
+        semaphore = asyncio.Semaphore(max_concurrency or len(awaitables))
+
+        async def run(aw):
+            async with semaphore:
+                # tasks copy the context, connection included
+                self._detach_connection()
+                return await aw
+
+        tasks = [asyncio.ensure_future(run(aw)) for aw in awaitables]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            _close_pending(awaitables)
+
+    def _detach_connection(self):
+        """Gives the current task a connection of its own"""
+        self._connection_context.set(Connection(self._backend))
+
+    # Without hooks these hand the databases coroutine or generator over
+    # as it is, instrumentation costs nothing when it's off.
+
+    def fetch_all(self, query, values=None):
+        fetch_all = super().fetch_all
+        if self._prepare(query, values):
+            fetch_all = self._fetch_prepared
+        if not self.instrumentation:
+            return fetch_all(query, values)
+        return self.instrumentation.execute(
+            fetch_all, query, values, self.dialect, len)
+
+    def fetch_one(self, query, values=None):
+        fetch_one = super().fetch_one
+        if self._prepare(query, values):
+            fetch_one = self._fetch_one_prepared
+        if not self.instrumentation:
+            return fetch_one(query, values)
+        return self.instrumentation.execute(
+            fetch_one, query, values, self.dialect,
+            lambda row: int(row is not None))
+
+    def fetch_val(self, query, values=None, column=0):
+        if self._prepare(query, values):
+            async def fetch_val(query, values):
+                row = await self._fetch_one_prepared(query, values)
+                return None if row is None else row[column]
+        else:
+            fetch_val_ = super().fetch_val
+
+            def fetch_val(query, values):
+                return fetch_val_(query, values, column=column)
+        if not self.instrumentation:
+            return fetch_val(query, values)
+        return self.instrumentation.execute(
+            fetch_val, query, values, self.dialect)
+
+    def _prepare(self, query, values):
+        return (
+            self.prepared_statements and values is None and
+            isinstance(query, BoundStatement) and query.cached and
+            self.dialect.name == "postgresql")
+
+    async def _fetch_prepared(self, query, values=None, one=False):
+        """Runs query as a prepared statement of the connection"""
+        from databases.backends.postgres import Record
+        connection = self.connection()
+        async with connection:
+            backend = connection._connection
+            statement = PostgresStatement.get(query, backend)
+            args = statement.args(query._compiled._params)
+            async with connection._query_lock:
+                rows = await self.prepared_statements.fetch(
+                    backend.raw_connection, statement.sql, args, one)
+        dialect = backend._dialect
+        if one:
+            return None if rows is None else Record(
+                rows, statement.result_columns, dialect,
+                statement.column_maps)
+        return [
+            Record(row, statement.result_columns, dialect,
+                   statement.column_maps) for row in rows
+        ]
+
+    def _fetch_one_prepared(self, query, values=None):
+        return self._fetch_prepared(query, values, one=True)
+
+    def execute(self, query, values=None):
+        if not self.instrumentation:
+            return super().execute(query, values)
+        return self.instrumentation.execute(
+            super().execute, query, values, self.dialect)
+
+    def execute_many(self, query, values):
+        if not self.instrumentation:
+            return super().execute_many(query, values)
+        # with values the statement goes to databases as it is
+        return self.instrumentation.execute(
+            super().execute_many, query, values, self.dialect,
+            lambda _: len(values))
+
+    def iterate(self, query, values=None):
+        if not self.instrumentation:
+            return super().iterate(query, values)
+        return self.instrumentation.iterate(
+            super().iterate, query, values, self.dialect)
+
+    async def load(self, ins, *keys):
+        """Fetches attributes left out by an only() or defer() query,
+        all of them when no keys are given"""
+        state = instance_state(ins)
+        mapper = state.mapper
+        if not keys:
+            keys = [
+                prop.key for prop in mapper.column_attrs
+                if is_unloaded(state, prop.key)
+            ]
+        if not keys:
+            return ins
+        columns = [mapper.column_attrs[key].columns[0] for key in keys]
+        expr = sql.select(
+            [col.label(key) for key, col in zip(keys, columns)]
+        ).select_from(mapper.persist_selectable)
+        for pk in mapper.primary_key:
+            key = mapper.get_property_by_column(pk).key
+            expr = expr.where(pk == committed_value(state, key))
+        row = await self.fetch_one(expr)
+        if row is None:
+            raise orm_exc.ObjectDeletedError(state)
+        for key in keys:
+            set_committed_value(ins, key, row[key])
+        mutable = mapper_plan(mapper).mutable
+        if mutable:
+            snapshot_mutable(state, mutable)
+        return ins
 
     async def add(self, *args):
         res = []
@@ -138,12 +1036,70 @@ class OMDatabase(Database):
         return res
 
     async def _add_impl(self, ins):
-        return await insert(ins, self)
+        pk_val = await insert(ins, self)
+        identity_map = self.get_identity_map()
+        if identity_map is not None:
+            identity_map.replace(ins)
+        return pk_val
+
+    async def add_all(self, instances, batch_size=500):
+        """Inserts instances grouped by model, with multi-row INSERTs of
+        up to batch_size rows, inside a single transaction"""
+        instances = list(instances)
+        async with self.transaction():
+            await insert_many(instances, self, batch_size=batch_size)
+        identity_map = self.get_identity_map()
+        if identity_map is not None:
+            for ins in instances:
+                identity_map.replace(ins)
+        return instances
+
+    async def upsert(self, instances, conflict_cols=None, update_cols=None,
+                     batch_size=500):
+        """Inserts instances, or updates the row with the same conflict_cols
+        values, with INSERT ... ON CONFLICT DO UPDATE (postgres, and
+        sqlite >= 3.35).
+
+        `instances` is an instance or a list of them, of single table
+        models. conflict_cols (the primary key by default) must have a
+        unique index, update_cols default to the remaining columns.
+        Lists are sent as multi-row statements of up to batch_size rows
+        inside a transaction, and the returned rows, keys and defaults,
+        are written back on the instances.
+        """
+        single = not isinstance(instances, (list, tuple))
+        if single:
+            instances = [instances]
+        async with self.transaction():
+            await upsert_many(
+                instances, self, conflict_cols, update_cols, batch_size)
+        identity_map = self.get_identity_map()
+        if identity_map is not None:
+            for ins in instances:
+                identity_map.replace(ins)
+        return instances[0] if single else instances
+
+    async def copy_into(self, model, rows, batch_size=10000):
+        """Bulk loads rows, model instances or dicts keyed by column,
+        into a model or a Table.
+
+        Uses COPY on asyncpg connections and batched executemany on
+        other backends. Generated primary keys are not set back on the
+        instances, use add_all for that.
+        """
+        async with self.transaction():
+            return await copy_rows(model, rows, self, batch_size=batch_size)
 
     async def update(self, ins):
-        return await update(ins, self)
+        await update(ins, self)
+        identity_map = self.get_identity_map()
+        if identity_map is not None:
+            identity_map.replace(ins)
 
     async def remove(self, ins):
+        identity_map = self.get_identity_map()
+        if identity_map is not None:
+            identity_map.discard(ins)
         mapper = inspect(ins).mapper
         pk_column = mapper.primary_key[0]
         pk_value = getattr(ins, pk_column.name)
@@ -155,12 +1111,103 @@ class OMDatabase(Database):
 
     delete = remove
 
+    async def remove_many(self, instances, chunk_size=1000):
+        """Deletes instances with one statement per table and chunk of
+        chunk_size keys, from the last table on the inheritance chain to
+        the first, inside a transaction"""
+        instances = list(instances)
+        identity_map = self.get_identity_map()
+        if identity_map is not None:
+            for ins in instances:
+                identity_map.discard(ins)
+        async with self.transaction():
+            await delete_many(instances, self, chunk_size=chunk_size)
+
+    async def update_many(self, instances, batch_size=500):
+        """Writes the changed columns of instances with a few statements,
+        `UPDATE ... FROM (VALUES ...)` on postgres, grouped by model,
+        table and changed columns, inside a transaction. See update()"""
+        instances = list(instances)
+        async with self.transaction():
+            await update_many(instances, self, batch_size=batch_size)
+        identity_map = self.get_identity_map()
+        if identity_map is not None:
+            for ins in instances:
+                identity_map.replace(ins)
+        return instances
+
+    def iterate_batches(self, query, values=None, batch_size=1000):
+        """Yields lists of up to batch_size records. On postgres each list
+        is a single fetch from a server side cursor."""
+        if not self.instrumentation:
+            return self._iterate_batches(query, values, batch_size)
+        return self.instrumentation.iterate(
+            lambda query, values: self._iterate_batches(
+                query, values, batch_size),
+            query, values, self.dialect, batches=True)
+
+    async def _iterate_batches(self, query, values, batch_size):
+        async with self.connection() as connection:
+            if self.dialect.name != "postgresql":
+                batch = []
+                async for record in connection.iterate(query, values):
+                    batch.append(record)
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+                if batch:
+                    yield batch
+                return
+
+            from databases.backends.postgres import Record
+            backend = connection._connection
+            sql_, args, result_columns = backend._compile(
+                connection._build_query(query, values))
+            column_maps = backend._create_column_maps(result_columns)
+            # same locking as Connection.iterate, cursors need a transaction
+            async with connection.transaction():
+                async with connection._query_lock:
+                    cursor = await backend.raw_connection.cursor(sql_, *args)
+                    while True:
+                        rows = await cursor.fetch(batch_size)
+                        if rows:
+                            yield [
+                                Record(row, result_columns, backend._dialect,
+                                       column_maps) for row in rows
+                            ]
+                        if len(rows) < batch_size:
+                            return
+
     @property
     def raw(self):
         # pointer to the raw asyncpg connection
         return self.connection().raw_connection
 
 
+class _IdentityMapScope:
+    def __init__(self, var):
+        self._var = var
+        self._token = None
+
+    def __enter__(self) -> IdentityMap:
+        identity_map = self._var.get()
+        if identity_map is None:
+            identity_map = IdentityMap()
+            self._token = self._var.set(identity_map)
+        return identity_map
+
+    def __exit__(self, *exc):
+        if self._token is not None:
+            self._var.reset(self._token)
+            self._token = None
+
+    async def __aenter__(self) -> IdentityMap:
+        return self.__enter__()
+
+    async def __aexit__(self, *exc):
+        self.__exit__(*exc)
+
+
 class OMBase:
     @classmethod
     def select(cls, *args, **kwargs):
@@ -170,62 +1217,606 @@ class OMBase:
 _marker = object()
 
 
+class Explain(Executable, ClauseElement):
+    """EXPLAIN (FORMAT JSON) of a statement, postgres only"""
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def _compile_explain(element, compiler, **kw):
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kw)
+
+
+def _close_pending(awaitables):
+    # coroutines never started would warn they were never awaited
+    for aw in awaitables:
+        if (asyncio.iscoroutine(aw) and
+                getcoroutinestate(aw) == CORO_CREATED):
+            aw.close()
+
+
+def timed(fn, event):
+    """fn adding its calls and their time to a map event"""
+    def map_result(row):
+        start = time.perf_counter()
+        ins = fn(row)
+        event.duration += time.perf_counter() - start
+        event.rows += 1
+        return ins
+    return map_result
+
+
+async def read_ahead(iterator, size):
+    """Consumes iterator from a task, keeping at most size items ahead of
+    the caller"""
+    queue = asyncio.Queue(maxsize=size)
+    done = object()
+
+    async def produce():
+        try:
+            async for item in iterator:
+                await queue.put((item, None))
+        except Exception as e:
+            await queue.put((done, e))
+        else:
+            await queue.put((done, None))
+        finally:
+            await iterator.aclose()
+
+    task = asyncio.ensure_future(produce())
+    try:
+        while True:
+            item, error = await queue.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        if not task.done():
+            task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+# asyncpg can't bind more than 32767 arguments on a single statement
+MAX_BIND_PARAMS = 32767
+
+DEFAULT = sql.literal_column("DEFAULT")
+
+
+def insert_values(ins, table):
+    """Column values of ins for an insert on table, applying column
+    defaults to the instance"""
+    return table_plan(table).insert_values(ins)
+
+
+def dict_values(row, table):
+    """Same as insert_values for a plain dict keyed by column key"""
+    return table_plan(table).dict_values(row)
+
+
 async def insert(ins, conn):
-    mapper = ins.__mapper__
+    """Inserts ins on every table of its inheritance chain.
+
+    On dialects with RETURNING (postgres) it's a single statement, tables
+    after the first are inserted from chained CTEs, and the primary key
+    and the columns not given (server defaults, sequences) are set back
+    on ins.
+    """
+    plan = mapper_plan(ins.__mapper__)
+    if conn.dialect.implicit_returning:
+        return await _insert_returning(ins, plan, conn)
     pk_val = None
     first = True
-    for table in mapper.tables:
-        values = {}
-        for column in table.columns:
-            val = getattr(ins, column.key)
-            if val is not None:
-                values[column.name] = val
-            elif column.default:
-                if column.default.is_callable:
-                    _val = column.default.arg({})
-                    values[column.name] = _val
-                    setattr(ins, column.name, _val)
-                elif column.default.is_scalar:
-                    values[column.name] = column.default.arg
-                    setattr(ins, column.name, column.default.arg)
-
-        expr = table.insert().values(values)
-        _pk_val = await conn.execute(expr)
+    for table in plan.tables:
+        values = table.insert_values(ins)
+        _pk_val = await conn.execute(table.insert(values, conn.dialect))
         # is first pk on inheritance chain (first table) and is not provided
         if first and _pk_val:
             pk_val = _pk_val
-            setattr(ins, mapper.primary_key[0].key, pk_val)
+            setattr(ins, plan.pk, pk_val)
             first = None
 
-        if mapper.inherit_condition is not None:
-            if (
-                mapper.inherit_condition.left ==
-                mapper.primary_key[0]
-            ):
-                col_name = mapper.inherit_condition.right.name
-                setattr(ins, col_name, pk_val)
+        if plan.inherit_key is not None:
+            setattr(ins, plan.inherit_key, pk_val)
+    commit_state(instance_state(ins))
     return pk_val
 
 
+async def _insert_returning(ins, plan, conn):
+    expr, returned = plan.insert_returning(
+        [table.insert_values(ins) for table in plan.tables], conn.dialect)
+    row = await conn.fetch_one(expr)
+    for i, col in enumerate(returned):
+        setattr(ins, col.key, row[i])
+    commit_state(instance_state(ins))
+    return getattr(ins, plan.pk)
+
+
 async def update(ins, conn):
-    mapper = ins.__mapper__
-    for table in mapper.tables:
+    """Writes the columns changed since ins was loaded or inserted.
+
+    Tables on the inheritance chain without changes are skipped, and
+    nothing is sent when nothing changed. Values mutated in place (a
+    dict on a JSON column) must be flagged with
+    `sqlalchemy.orm.attributes.flag_modified`, unless the column opts in
+    to comparing them with a copy taken on load with
+    `info={"mutable": True}`.
+    """
+    state = instance_state(ins)
+    changed = changed_keys(state)
+    if not changed:
+        return
+    for table in mapper_plan(ins.__mapper__).tables:
         values = {}
-        for column in table.columns:
-            val = getattr(ins, column.key, _marker)
-            if val != _marker:
-                values[column.name] = val
-
-            if column.onupdate:
-                if column.onupdate.is_callable:
-                    _val = column.onupdate.arg({})
-                    values[column.name] = _val
-                    setattr(ins, column.name, _val)
-                elif column.onupdate.is_scalar:
-                    values[column.name] = column.onupdate.arg
-                    setattr(ins, column.name, column.onupdate.arg)
-
-        expr = table.update().values(values)
-        for pk_ in table.primary_key.columns:
-            expr = expr.where(pk_ == values[pk_.key])
-        await conn.execute(expr)
+        for column, _ in table.columns:
+            if column.key in changed:
+                values[column.name] = getattr(ins, column.key)
+        if not values:
+            continue
+
+        for name, value in table.onupdate_values().items():
+            values[name] = value
+            setattr(ins, name, value)
+
+        pk = [committed_value(state, col.key) for col in table.pk]
+        await conn.execute(table.update(values, pk, conn.dialect))
+    commit_state(state)
+
+
+async def delete_many(instances, conn, chunk_size=1000):
+    groups = {}
+    for ins in instances:
+        groups.setdefault(ins.__mapper__, []).append(ins)
+    for mapper, group in groups.items():
+        for table in reversed(mapper.tables):
+            pk = list(table.primary_key.columns)
+            attrs = [mapper.get_property_by_column(col).key for col in pk]
+            keys = list(dict.fromkeys(
+                tuple(committed_value(instance_state(ins), attr)
+                      for attr in attrs)
+                for ins in group))
+            for i in range(0, len(keys), chunk_size):
+                await conn.execute(table.delete().where(
+                    pk_in(pk, keys[i:i + chunk_size], conn.dialect)))
+
+
+def onupdate_values(table, values=None):
+    """Python side onupdate values of table columns not in values"""
+    return table_plan(table).onupdate_values(values)
+
+
+async def update_many(instances, conn, batch_size=500):
+    groups = {}
+    for ins in instances:
+        state = instance_state(ins)
+        changed = changed_keys(state)
+        if changed:
+            groups.setdefault(ins.__mapper__, []).append((ins, changed))
+
+    for mapper, group in groups.items():
+        for table in mapper.tables:
+            pk = list(table.primary_key.columns)
+            by_columns = {}
+            for ins, changed in group:
+                columns = tuple(
+                    col for col in table.columns if col.key in changed)
+                if columns:
+                    by_columns.setdefault(columns, []).append(ins)
+
+            for columns, rows in by_columns.items():
+                onupdate = onupdate_values(table)
+                for ins in rows:
+                    for name, value in onupdate.items():
+                        setattr(ins, name, value)
+                set_columns = list(columns) + [
+                    col for col in table.columns
+                    if col.name in onupdate and col not in columns]
+                size = max(1, min(batch_size, MAX_BIND_PARAMS // (
+                    len(pk) + len(set_columns))))
+                for i in range(0, len(rows), size):
+                    await _update_rows(
+                        table, pk, set_columns, rows[i:i + size], conn)
+
+    for ins, _ in (item for group in groups.values() for item in group):
+        state = instance_state(ins)
+        commit_state(state)
+
+
+async def _update_rows(table, pk, columns, rows, conn):
+    keys = [
+        [committed_value(instance_state(ins), col.key) for col in pk]
+        for ins in rows
+    ]
+    values = [[getattr(ins, col.key) for col in columns] for ins in rows]
+    if conn.dialect.name != "postgresql":
+        # sqlite, in process, one statement per row is cheap
+        plan = table_plan(table)
+        for key, row in zip(keys, values):
+            await conn.execute(plan.update(dict(
+                (col.name, value) for col, value in zip(columns, row)),
+                key, conn.dialect))
+        return
+    data = Values(
+        [sql.column(f"key_{i}", col.type) for i, col in enumerate(pk)] +
+        [sql.column(col.name, col.type) for col in columns],
+        [key + row for key, row in zip(keys, values)],
+        name="data")
+    expr = table.update().values(
+        {col.name: data.c[col.name] for col in columns})
+    for i, col in enumerate(pk):
+        expr = expr.where(col == data.c[f"key_{i}"])
+    await conn.execute(expr)
+
+
+def changed_keys(state):
+    """Attribute keys modified since the state was last committed"""
+    dict_ = state.dict
+    manager = state.manager
+    changed = set()
+    for key, original in state.committed_state.items():
+        if (
+            original is NO_VALUE or original is NEVER_SET or
+            key not in dict_ or
+            not manager[key].impl.is_equal(dict_[key], original)
+        ):
+            changed.add(key)
+    return changed
+
+
+def commit_state(state):
+    """Commits state, its current values are the reference for changes"""
+    state._commit_all(state.dict)
+    mutable = mapper_plan(state.mapper).mutable
+    if mutable:
+        snapshot_mutable(state, mutable)
+
+
+def snapshot_mutable(state, keys):
+    """Keeps a copy of the values of keys (mutable columns) as committed
+    ones, changed_keys() finds the changes made to them in place"""
+    dict_ = state.dict
+    committed = state.committed_state
+    for key in keys:
+        if key in dict_ and key not in committed:
+            committed[key] = copy.deepcopy(dict_[key])
+
+
+def committed_value(state, key):
+    original = state.committed_state.get(key, _marker)
+    if original is _marker or original is NO_VALUE or original is NEVER_SET:
+        return state.dict.get(key)
+    return original
+
+
+async def insert_many(instances, conn, batch_size=500):
+    groups = {}
+    for ins in instances:
+        groups.setdefault(ins.__mapper__, []).append(ins)
+
+    returning = conn.dialect.implicit_returning
+    for mapper, group in groups.items():
+        for table in mapper.tables:
+            sync_inherited_keys(mapper, table, group)
+            # multi-row VALUES need the same columns on every row
+            by_columns = {}
+            for ins in group:
+                values = insert_values(ins, table)
+                by_columns.setdefault(tuple(values), []).append((ins, values))
+
+            pk_columns = list(table.primary_key.columns)
+            for columns, rows in by_columns.items():
+                if not returning:
+                    await _insert_rows(table, pk_columns, rows, conn)
+                    continue
+                size = max(1, min(
+                    batch_size, MAX_BIND_PARAMS // max(1, len(columns))))
+                returned = returned_columns(table, columns)
+                for i in range(0, len(rows), size):
+                    batch = rows[i:i + size]
+                    expr = table.insert().values([
+                        # an empty row is not valid on multi-row VALUES
+                        values or {pk_columns[0].name: DEFAULT}
+                        for _, values in batch
+                    ]).returning(*returned)
+                    result = await conn.fetch_all(expr)
+                    for (ins, _), row in zip(batch, result):
+                        for idx, column in enumerate(returned):
+                            setattr(ins, column.key, row[idx])
+
+    for ins in instances:
+        state = instance_state(ins)
+        commit_state(state)
+
+
+async def upsert_many(instances, conn, conflict_cols=None, update_cols=None,
+                      batch_size=500):
+    dialect = conn.dialect
+    if dialect.name not in ("postgresql", "sqlite"):
+        raise NotImplementedError(f"upsert is not supported on {dialect.name}")
+    groups = {}
+    for ins in instances:
+        groups.setdefault(ins.__mapper__, []).append(ins)
+
+    for mapper, group in groups.items():
+        if len(mapper.tables) != 1:
+            raise ValueError(f"upsert only supports single table models, "
+                             f"{mapper} maps {len(mapper.tables)}")
+        table = mapper.local_table
+        if conflict_cols is None:
+            conflict = list(mapper.primary_key)
+        else:
+            conflict = [_mapper_column(mapper, col) for col in conflict_cols]
+        if update_cols is None:
+            update = [
+                col for col in table.columns
+                if col not in conflict and not col.primary_key
+            ]
+        else:
+            update = [_mapper_column(mapper, col) for col in update_cols]
+
+        by_columns = {}
+        for ins in group:
+            values = insert_values(ins, table)
+            key = tuple(values.get(col.name) for col in conflict)
+            if None in key:
+                raise ValueError(
+                    f"{ins} has no value for the conflict columns")
+            by_columns.setdefault(tuple(values), []).append((ins, key, values))
+
+        size = max(1, min(batch_size, MAX_BIND_PARAMS // len(table.columns)))
+        for columns, rows in by_columns.items():
+            for batch in _upsert_batches(rows, size):
+                returned = await _upsert(
+                    table, conflict, update, batch, conn)
+                for ins, key, _ in batch:
+                    row = returned[key]
+                    for column in table.columns:
+                        setattr(ins, column.key, row[column.name])
+
+    for ins in instances:
+        state = instance_state(ins)
+        commit_state(state)
+
+
+def _mapper_column(mapper, col):
+    return mapper.columns[col if isinstance(col, str) else col.key]
+
+
+def _upsert_batches(rows, size):
+    # a statement can't insert and then update the same row
+    batch, keys = [], set()
+    for row in rows:
+        if len(batch) >= size or row[1] in keys:
+            yield batch
+            batch, keys = [], set()
+        batch.append(row)
+        keys.add(row[1])
+    if batch:
+        yield batch
+
+
+async def _upsert(table, conflict, update, batch, conn):
+    """Runs the upsert of batch, returning the resulting rows by their
+    conflict key"""
+    values = [values for _, _, values in batch]
+    set_ = {}
+    for column in update:
+        set_[column.name] = sql.literal_column(
+            "excluded." + conn.dialect.identifier_preparer.quote(column.name),
+            type_=column.type)
+    if set_:
+        # like update(), onupdate values win over the given ones
+        for name, value in onupdate_values(table).items():
+            if table.c[name] not in conflict:
+                set_[name] = sql.bindparam(
+                    None, value, type_=table.c[name].type)
+    else:
+        # DO NOTHING would not return the existing rows
+        set_[conflict[0].name] = sql.literal_column(
+            "excluded." + conn.dialect.identifier_preparer.quote(
+                conflict[0].name), type_=conflict[0].type)
+
+    if conn.dialect.name == "postgresql":
+        expr = pg_insert(table).values(values).on_conflict_do_update(
+            index_elements=conflict, set_=set_).returning(*table.columns)
+        rows = await conn.fetch_all(expr)
+    else:
+        expr = Upsert(table.insert().values(values), conflict, set_,
+                      list(table.columns))
+        rows = [
+            _process_row(row, table.columns, conn.dialect)
+            for row in await conn.fetch_all(expr)
+        ]
+    return {tuple(row[col.name] for col in conflict): row for row in rows}
+
+
+def _process_row(row, columns, dialect):
+    values = {}
+    for column in columns:
+        value = row[column.name]
+        processor = column.type._cached_result_processor(dialect, None)
+        values[column.name] = processor(value) if processor else value
+    return values
+
+
+class Values(FromClause):
+    """`(VALUES (...), ...) AS name (columns)`, with typed binds"""
+
+    named_with_column = True
+
+    def __init__(self, columns, rows, name):
+        self._column_args = columns
+        self.rows = rows
+        self.name = name
+
+    def _populate_column_collection(self):
+        for column in self._column_args:
+            column._make_proxy(self)
+
+    @property
+    def _from_objects(self):
+        return [self]
+
+
+@compiles(Values)
+def _compile_values(element, compiler, asfrom=False, **kw):
+    columns = element._column_args
+    rows = ", ".join(
+        "(%s)" % ", ".join(
+            # VALUES params have no type to infer, cast them
+            compiler.process(sql.cast(
+                sql.bindparam(None, value, type_=col.type), col.type), **kw)
+            for col, value in zip(columns, row))
+        for row in element.rows)
+    text = f"(VALUES {rows})"
+    if asfrom:
+        quote = compiler.preparer.quote
+        text += " AS %s (%s)" % (
+            quote(element.name),
+            ", ".join(quote(col.name) for col in columns))
+    return text
+
+
+class Upsert(Executable, ClauseElement):
+    """INSERT ... ON CONFLICT DO UPDATE ... RETURNING for sqlite, which
+    sqlalchemy 1.3 can't compile"""
+
+    # read by the compiler after visiting the wrapped insert
+    _returning = ()
+
+    def __init__(self, insert, conflict, set_, returning):
+        self.insert = insert
+        self.conflict = conflict
+        self.set_ = set_
+        self.returning = returning
+
+
+@compiles(Upsert)
+def _compile_upsert(element, compiler, **kw):
+    quote = compiler.preparer.quote
+    # positional binds follow the order they are processed in
+    insert = compiler.process(element.insert, **kw)
+    conflict = ", ".join(quote(c.name) for c in element.conflict)
+    sets = ", ".join(
+        f"{quote(name)} = {compiler.process(value, **kw)}"
+        for name, value in element.set_.items())
+    return (
+        f"{insert} ON CONFLICT ({conflict}) "
+        f"DO UPDATE SET {sets} "
+        f"RETURNING {', '.join(quote(c.name) for c in element.returning)}")
+
+
+async def _insert_rows(table, pk_columns, rows, conn):
+    # backends without RETURNING only hand back the last row id
+    for ins, values in rows:
+        pk_val = await conn.execute(table.insert().values(values))
+        if len(pk_columns) == 1 and pk_val:
+            key = pk_columns[0].key
+            if getattr(ins, key) is None:
+                setattr(ins, key, pk_val)
+
+
+def sync_inherited_keys(mapper, table, instances):
+    """Copies the parent primary key onto the foreign key columns that
+    join table to its parent on the inheritance chain"""
+    for parent_col, child_col in inherited_pairs(mapper, table):
+        for ins in instances:
+            if getattr(ins, child_col.key) is None:
+                setattr(ins, child_col.key, getattr(ins, parent_col.key))
+
+
+async def copy_rows(model, rows, conn, batch_size=10000):
+    if isinstance(model, Table):
+        mapper, tables = None, [model]
+    else:
+        mapper = inspect(model)
+        tables = mapper.tables
+
+    rows = [
+        dict(row) if isinstance(row, Mapping) else row for row in rows
+    ]
+    dicts = [row for row in rows if isinstance(row, dict)]
+    instances = [row for row in rows if not isinstance(row, dict)]
+    check_dict_keys(tables, dicts)
+
+    async with conn.connection() as connection:
+        raw = connection.raw_connection
+        copy = getattr(raw, "copy_records_to_table", None)
+        for table in tables:
+            if mapper is not None:
+                sync_inherited_keys(mapper, table, instances)
+                _sync_inherited_dicts(mapper, table, dicts)
+            by_columns = {}
+            for values in (
+                [insert_values(ins, table) for ins in instances] +
+                [dict_values(row, table) for row in dicts]
+            ):
+                by_columns.setdefault(tuple(values), []).append(values)
+
+            for names, values in by_columns.items():
+                _check_inherited_keys(mapper, table, names)
+                for i in range(0, len(values), batch_size):
+                    batch = values[i:i + batch_size]
+                    if copy is None:
+                        # the insert binds values by column key
+                        by_name = table_plan(table).by_name
+                        await conn.execute_many(table.insert(), [
+                            {by_name[name].key: value
+                             for name, value in row.items()}
+                            for row in batch
+                        ])
+                    else:
+                        await copy(
+                            table.name,
+                            records=_copy_records(
+                                table, names, batch, conn.dialect),
+                            columns=names,
+                            schema_name=table.schema)
+    for ins in instances:
+        state = instance_state(ins)
+        commit_state(state)
+    return len(rows)
+
+
+def _copy_records(table, names, batch, dialect):
+    # COPY skips sqlalchemy, so run the bind processors (enums, json...)
+    by_name = table_plan(table).by_name
+    processors = [
+        by_name[name].type._cached_bind_processor(dialect)
+        for name in names
+    ]
+    records = []
+    for values in batch:
+        records.append(tuple(
+            proc(values[name]) if proc else values[name]
+            for name, proc in zip(names, processors)
+        ))
+    return records
+
+
+def _sync_inherited_dicts(mapper, table, rows):
+    for m in mapper.iterate_to_root():
+        if m.inherits is None:
+            continue
+        for parent_col, child_col in m._inherits_equated_pairs:
+            if child_col.table is not table:
+                continue
+            for row in rows:
+                if row.get(child_col.key) is None:
+                    row[child_col.key] = row.get(parent_col.key)
+
+
+def _check_inherited_keys(mapper, table, names):
+    if mapper is None or table is mapper.tables[0]:
+        return
+    for column in table.primary_key.columns:
+        if column.name not in names:
+            raise ValueError(
+                f"copy_rows needs primary keys for {table.name}, "
+                "generated keys can't be read back from COPY")
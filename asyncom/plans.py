@@ -0,0 +1,254 @@
+"""Write plans cached per mapper.
+
+`insert()` and `update()` write the same models with the same handful of
+column sets over and over. A plan keeps what they need from the mapper
+and its tables (column order, python side defaults, primary keys, the
+inheritance linkage) and compiles each statement shape once per dialect,
+so a write only gathers the values and binds them.
+"""
+
+from functools import lru_cache
+
+from sqlalchemy import exc, sql
+
+from .cache import BoundStatement
+
+
+@lru_cache(maxsize=None)
+def mapper_plan(mapper):
+    return MapperPlan(mapper)
+
+
+@lru_cache(maxsize=None)
+def table_plan(table):
+    return TablePlan(table)
+
+
+def python_default(default):
+    """Zero argument callable for a python side column default (or
+    onupdate), None when there is none"""
+    if default is None:
+        return None
+    arg = default.arg
+    if default.is_callable:
+        return lambda: arg({})
+    if default.is_scalar:
+        return lambda: arg
+    return None
+
+
+def bind(compiled, params):
+    """Executable for compiled with params keyed by bind name"""
+    return BoundStatement(compiled, compiled.construct_params(params))
+
+
+class TablePlan:
+
+    __slots__ = ("table", "columns", "by_name", "keys", "pk", "onupdate",
+                 "_statements")
+
+    def __init__(self, table):
+        self.table = table
+        # (column, python side default) on table order
+        self.columns = tuple(
+            (col, python_default(col.default)) for col in table.columns)
+        self.by_name = {col.name: col for col in table.columns}
+        self.keys = frozenset(col.key for col in table.columns)
+        self.pk = tuple(table.primary_key.columns)
+        self.onupdate = tuple(
+            (col, fn) for col, fn in (
+                (col, python_default(col.onupdate)) for col in table.columns)
+            if fn is not None)
+        # compiled statements by (kind, column keys, dialect)
+        self._statements = {}
+
+    def insert_values(self, ins):
+        """Column values of ins for an insert, applying column defaults
+        to the instance"""
+        values = {}
+        for column, default in self.columns:
+            val = getattr(ins, column.key)
+            if val is not None:
+                values[column.name] = val
+            elif default is not None:
+                val = values[column.name] = default()
+                setattr(ins, column.name, val)
+        return values
+
+    def dict_values(self, row):
+        """Same as insert_values for a plain dict keyed by column key,
+        defaults only apply to missing keys and an explicit None is kept
+        as NULL. Keys of other tables are ignored, see check_dict_keys()
+        """
+        values = {}
+        for column, default in self.columns:
+            if column.key in row:
+                values[column.name] = row[column.key]
+            elif default is not None:
+                values[column.name] = default()
+        return values
+
+    def onupdate_values(self, values=None):
+        """Python side onupdate values of the columns not in values"""
+        return {
+            col.name: fn() for col, fn in self.onupdate
+            if not values or col.name not in values
+        }
+
+    def insert(self, values, dialect):
+        """Executable inserting values, keyed by column name"""
+        keys, params = self._params(values)
+        key = ("insert", keys, dialect)
+        compiled = self._statements.get(key)
+        if compiled is None:
+            compiled = self._statements[key] = self.table.insert().compile(
+                dialect=dialect, column_keys=list(keys))
+        return bind(compiled, params)
+
+    def update(self, values, pk, dialect):
+        """Executable setting values (keyed by column name) on the row
+        with primary key pk"""
+        keys, params = self._params(values)
+        key = ("update", keys, dialect)
+        compiled = self._statements.get(key)
+        if compiled is None:
+            expr = self.table.update()
+            for i, col in enumerate(self.pk):
+                expr = expr.where(
+                    col == sql.bindparam(f"pk_{i}", type_=col.type))
+            compiled = self._statements[key] = expr.compile(
+                dialect=dialect, column_keys=list(keys))
+        for i, value in enumerate(pk):
+            params[f"pk_{i}"] = value
+        return bind(compiled, params)
+
+    def _params(self, values):
+        # the compiler names binds after column keys
+        params = {
+            self.by_name[name].key: value for name, value in values.items()
+        }
+        return tuple(params), params
+
+
+class MapperPlan:
+
+    __slots__ = ("mapper", "tables", "pk", "inherits", "inherit_key",
+                 "mutable", "_statements")
+
+    def __init__(self, mapper):
+        self.mapper = mapper
+        self.tables = tuple(table_plan(table) for table in mapper.tables)
+        self.pk = mapper.primary_key[0].key
+        # (parent column, table column) pairs of each table
+        self.inherits = tuple(
+            tuple(inherited_pairs(mapper, table)) for table in mapper.tables)
+        # attribute receiving the generated key of the first table
+        self.inherit_key = None
+        condition = mapper.inherit_condition
+        if condition is not None and condition.left == mapper.primary_key[0]:
+            self.inherit_key = condition.right.name
+        # attributes of columns with info={"mutable": True}, their
+        # loaded values are copied to find changes made in place
+        self.mutable = tuple(
+            prop.key for prop in mapper.column_attrs
+            if prop.columns[0].info.get("mutable"))
+        # compiled returning inserts by (column names per table, dialect)
+        self._statements = {}
+
+    def insert_returning(self, values, dialect):
+        """Executable inserting values (a dict per table) in a single
+        statement, and the columns of the row it returns.
+
+        Tables after the first are inserted from chained CTEs taking the
+        key of their parent insert.
+        """
+        shape = tuple(tuple(table_values) for table_values in values)
+        key = (shape, dialect)
+        entry = self._statements.get(key)
+        if entry is None:
+            entry = self._statements[key] = self._insert_returning(
+                shape, dialect)
+        compiled, returned = entry
+        params = {
+            f"t{i}_{name}": value
+            for i, table_values in enumerate(values)
+            for name, value in table_values.items()
+        }
+        statement = bind(compiled, params)
+        statement.writes = True
+        return statement, returned
+
+    def _insert_returning(self, shape, dialect):
+        ctes = {}
+        returned = []
+        expr = None
+        chained = len(self.tables) > 1
+        for i, (plan, names, pairs) in enumerate(
+                zip(self.tables, shape, self.inherits)):
+            table = plan.table
+            values = {
+                name: sql.bindparam(
+                    f"t{i}_{name}", type_=plan.by_name[name].type)
+                for name in names
+            }
+            for parent_col, child_col in pairs:
+                # the parent key is only known by the parent insert
+                values[child_col.name] = \
+                    ctes[parent_col.table].c[parent_col.name]
+            returning = returned_columns(table, values)
+            if ctes:
+                expr = table.insert().from_select(list(values), sql.select([
+                    value.label(name) for name, value in values.items()
+                ]))
+            else:
+                expr = table.insert().values(values)
+            expr = expr.returning(*returning)
+            if chained:
+                ctes[table] = expr = expr.cte(f"insert_{i}")
+            returned.extend((expr, col) for col in returning)
+
+        if chained:
+            expr = sql.select([
+                cte.c[col.name].label(f"c{i}")
+                for i, (cte, col) in enumerate(returned)
+            ])
+            for cte in ctes.values():
+                expr = expr.select_from(cte)
+        compiled = expr.compile(dialect=dialect)
+        return compiled, tuple(col for _, col in returned)
+
+
+def check_dict_keys(tables, rows):
+    """Raises, as SQLAlchemy does, when the dict rows to insert on tables
+    have keys that are not column keys of any of them"""
+    known = frozenset().union(*(table_plan(table).keys for table in tables))
+    seen = set()
+    for row in rows:
+        keys = tuple(row)
+        if keys in seen:
+            continue
+        seen.add(keys)
+        unknown = [key for key in keys if key not in known]
+        if unknown:
+            raise exc.CompileError(
+                f"Unconsumed column names: {', '.join(unknown)}")
+
+
+def returned_columns(table, values):
+    """Columns to return from an insert of values, the primary key and
+    the ones the database fills"""
+    return [
+        col for col in table.columns
+        if col.primary_key or col.name not in values
+    ]
+
+
+def inherited_pairs(mapper, table):
+    """(parent column, table column) pairs joining table to its parent
+    on the inheritance chain"""
+    for m in mapper.iterate_to_root():
+        if m.inherits is None:
+            continue
+        for parent_col, child_col in m._inherits_equated_pairs:
+            if child_col.table is table:
+                yield parent_col, child_col
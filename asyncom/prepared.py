@@ -0,0 +1,135 @@
+"""Prepared statements for OMQuery shapes on asyncpg.
+
+    db = OMDatabase(url, prepared_statements=100)
+
+Statements coming from the statement cache are prepared once per pooled
+connection, through its asyncpg handle, and later calls only bind and
+execute them, skipping the text SQL path of `databases` (and asyncpg's
+own lookup by query text). Each connection keeps an LRU of up to
+`prepared_statements` of them, and `db.prepared_statements.info()`
+counts hits and misses over all connections.
+
+Only postgres connections are affected, other backends ignore the
+setting.
+"""
+
+import weakref
+from collections import OrderedDict
+
+from .cache import CacheInfo
+
+try:
+    from asyncpg.exceptions import InvalidCachedStatementError
+    from asyncpg.prepared_stmt import PreparedStatement
+except ImportError:  # pragma: no cover
+    PreparedStatement = None
+
+    class InvalidCachedStatementError(Exception):
+        pass
+
+
+class PreparedStatements:
+    """LRUs of asyncpg prepared statements, one per connection"""
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # real asyncpg connection -> OrderedDict of sql -> statement
+        self._connections = weakref.WeakKeyDictionary()
+
+    def __bool__(self):
+        return self.maxsize > 0
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, sum(
+            len(entries) for entries in self._connections.values()))
+
+    def clear(self):
+        self._connections.clear()
+        self.hits = self.misses = 0
+
+    async def get(self, raw, sql):
+        """Prepared statement for sql on the raw connection"""
+        con = _connection(raw)
+        entries = self._connections.get(con)
+        if entries is None:
+            entries = self._connections[con] = OrderedDict()
+        statement = entries.get(sql)
+        if statement is not None:
+            self.hits += 1
+            entries.move_to_end(sql)
+            if statement._con_release_ctr != con._pool_release_ctr:
+                # asyncpg invalidates the statement objects of a checkout
+                # when it's released, but the pool reset keeps the server
+                # side statement, wrap it again for this checkout
+                statement = entries[sql] = PreparedStatement(
+                    con, sql, statement._state)
+            return statement
+        self.misses += 1
+        statement = entries[sql] = await raw.prepare(sql)
+        if len(entries) > self.maxsize:
+            # asyncpg deallocates statements once they are not referenced
+            entries.popitem(last=False)
+        return statement
+
+    async def fetch(self, raw, sql, args, one=False):
+        """Rows of the prepared sql run with args, the first one or None
+        with one"""
+        for retry in (True, False):
+            statement = await self.get(raw, sql)
+            try:
+                if one:
+                    return await statement.fetchrow(*args)
+                return await statement.fetch(*args)
+            except InvalidCachedStatementError:
+                # the schema changed under it, prepare it again
+                self.discard(raw, sql)
+                if not retry:
+                    raise
+
+    def discard(self, raw, sql):
+        entries = self._connections.get(_connection(raw))
+        if entries is not None:
+            entries.pop(sql, None)
+
+
+def _connection(raw):
+    # pools hand out a new proxy on each acquire, statements belong to
+    # the connection behind it
+    return getattr(raw, "_con", raw)
+
+
+class PostgresStatement:
+    """What databases derives from a compiled statement on each call
+    (the $n SQL, the bind order and processors and the result columns),
+    derived once"""
+
+    __slots__ = ("sql", "names", "processors", "result_columns",
+                 "column_maps")
+
+    def __init__(self, compiled, params, backend):
+        self.names = sorted(params)
+        self.sql = compiled.string % {
+            name: f"${i}" for i, name in enumerate(self.names, start=1)}
+        self.processors = compiled._bind_processors
+        self.result_columns = compiled._result_columns
+        self.column_maps = backend._create_column_maps(self.result_columns)
+
+    @classmethod
+    def get(cls, bound, backend):
+        """The (memoized) statement of a BoundStatement"""
+        compiled = bound._compiled._compiled
+        statement = getattr(compiled, "_asyncom_postgres", None)
+        if statement is None:
+            statement = compiled._asyncom_postgres = cls(
+                compiled, bound._compiled._params, backend)
+        return statement
+
+    def args(self, params):
+        processors = self.processors
+        return [
+            processors[name](params[name]) if name in processors
+            else params[name]
+            for name in self.names
+        ]
@@ -0,0 +1,80 @@
+"""Read only records for OMQuery.readonly().
+
+Mapped instances carry SQLAlchemy instrumentation state, that's needed
+to track changes but wasted on rows that are only read. Records are
+instances of a `__slots__` class generated once per model, with the
+column attributes and the plain properties of the model.
+"""
+
+from functools import lru_cache
+
+
+class ReadOnlyRecord:
+    __slots__ = ()
+    _fields = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read only")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is read only")
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self._astuple() == other._astuple()
+
+    def __hash__(self):
+        return hash(self._astuple())
+
+    def __repr__(self):
+        values = ", ".join(
+            f"{name}={getattr(self, name, None)!r}" for name in self._fields)
+        return f"{type(self).__name__}({values})"
+
+    def _astuple(self):
+        return tuple(getattr(self, name, None) for name in self._fields)
+
+    def _asdict(self):
+        return {
+            name: getattr(self, name) for name in self._fields
+            if hasattr(self, name)
+        }
+
+
+@lru_cache(maxsize=None)
+def record_class(mapper):
+    """The read only record class for mapper"""
+    model = mapper.class_
+    fields = tuple(prop.key for prop in mapper.column_attrs)
+    namespace = {
+        "__slots__": fields,
+        "__module__": model.__module__,
+        "__qualname__": f"{model.__qualname__}Record",
+        "_fields": fields,
+        "__model__": model,
+    }
+    for klass in reversed(model.__mro__):
+        for name, value in vars(klass).items():
+            if isinstance(value, property) and name not in fields:
+                namespace[name] = value
+    return type(f"{model.__name__}Record", (ReadOnlyRecord,), namespace)
+
+
+@lru_cache(maxsize=512)
+def record_mapper(mapper, names):
+    """Builds the row to record function for a column layout, `names`
+    being the attribute for each row position"""
+    cls = record_class(mapper)
+    new = object.__new__
+    scope = {"new": new, "cls": cls}
+    lines = ["def map_result(row):", "    ins = new(cls)"]
+    for i, name in enumerate(names):
+        if name not in cls._fields:
+            continue
+        # slot descriptors don't go through the read only __setattr__
+        scope[f"set_{i}"] = getattr(cls, name).__set__
+        lines.append(f"    set_{i}(ins, row[{i}])")
+    lines.append("    return ins")
+    exec("\n".join(lines), scope)
+    return scope["map_result"]
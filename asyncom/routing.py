@@ -0,0 +1,176 @@
+"""OMDatabase routing OMQuery reads to replicas.
+
+    db = RoutedDatabase(writer_url, readers=[replica1, replica2],
+                        balance="least_in_flight", read_your_writes=2.0)
+
+The database itself is the writer: add, update, remove, the bulk
+helpers, statements sent with execute() or fetch_*() and OMQuery.update
+and delete go to it. OMQuery reads go to a reader, picked round-robin or
+by the fewest queries in flight, except:
+
+- inside a transaction, or with force_rollback, they use the writer
+  connection (and see its uncommitted writes)
+- for `read_your_writes` seconds after a write of the current task (and
+  the tasks it starts afterwards) they go to the writer, so replication
+  lag doesn't hide them
+"""
+
+import itertools
+import time
+from contextvars import ContextVar
+
+from databases.core import Transaction
+
+from .cache import BoundStatement
+from .om import OMDatabase
+
+BALANCES = ("round_robin", "least_in_flight")
+
+
+class ReaderDatabase(OMDatabase):
+    """A replica of a RoutedDatabase, counting its queries in flight"""
+
+    def __init__(self, url, **options):
+        super().__init__(url, **options)
+        self.in_flight = 0
+
+    async def _counted(self, awaitable):
+        self.in_flight += 1
+        try:
+            return await awaitable
+        finally:
+            self.in_flight -= 1
+
+    async def _counted_iter(self, iterator):
+        self.in_flight += 1
+        try:
+            async for item in iterator:
+                yield item
+        finally:
+            self.in_flight -= 1
+            await iterator.aclose()
+
+    def fetch_all(self, query, values=None):
+        return self._counted(super().fetch_all(query, values))
+
+    def fetch_one(self, query, values=None):
+        return self._counted(super().fetch_one(query, values))
+
+    def fetch_val(self, query, values=None, column=0):
+        return self._counted(super().fetch_val(query, values, column))
+
+    def iterate(self, query, values=None):
+        return self._counted_iter(super().iterate(query, values))
+
+    def iterate_batches(self, query, values=None, batch_size=1000):
+        return self._counted_iter(
+            super().iterate_batches(query, values, batch_size))
+
+
+class RoutedDatabase(OMDatabase):
+
+    def __init__(self, url, readers=(), *, balance="round_robin",
+                 read_your_writes=0, **options):
+        if balance not in BALANCES:
+            raise ValueError(
+                f"balance must be one of {', '.join(BALANCES)}")
+        super().__init__(url, **options)
+        reader_options = {
+            key: value for key, value in options.items()
+            if key not in ("force_rollback", "hooks")
+        }
+        self.readers = [
+            ReaderDatabase(reader_url, **reader_options)
+            for reader_url in readers
+        ]
+        for reader in self.readers:
+            # one set of hooks, statements are compiled by the writer
+            reader.instrumentation = self.instrumentation
+        self.balance = balance
+        self.read_your_writes = read_your_writes
+        self._next = itertools.count()
+        self._last_write = ContextVar(
+            f"asyncom_last_write_{id(self)}", default=None)
+
+    async def connect(self):
+        await super().connect()
+        for reader in self.readers:
+            await reader.connect()
+
+    async def disconnect(self):
+        for reader in self.readers:
+            await reader.disconnect()
+        await super().disconnect()
+
+    def reader(self):
+        if not self.readers or self.in_transaction():
+            return self
+        if self.read_your_writes:
+            last = self._last_write.get()
+            if (last is not None and
+                    time.monotonic() - last < self.read_your_writes):
+                return self
+        start = next(self._next) % len(self.readers)
+        if self.balance == "round_robin":
+            return self.readers[start]
+        # from a rotating start, ties don't always pick the first one
+        order = self.readers[start:] + self.readers[:start]
+        return min(order, key=lambda reader: reader.in_flight)
+
+    def _detach_connection(self):
+        super()._detach_connection()
+        for reader in self.readers:
+            reader._detach_connection()
+
+    def mark_write(self):
+        """Starts the read-your-writes window of the current task"""
+        if self.read_your_writes:
+            self._last_write.set(time.monotonic())
+
+    def transaction(self, *, force_rollback=False, **kwargs):
+        return _WriterTransaction(
+            self, self.connection, force_rollback=force_rollback, **kwargs)
+
+    async def _marked(self, awaitable):
+        try:
+            return await awaitable
+        finally:
+            self.mark_write()
+
+    def execute(self, query, values=None):
+        return self._marked(super().execute(query, values))
+
+    def execute_many(self, query, values):
+        return self._marked(super().execute_many(query, values))
+
+    def fetch_all(self, query, values=None):
+        if self.read_your_writes and is_write(query):
+            return self._marked(super().fetch_all(query, values))
+        return super().fetch_all(query, values)
+
+    def fetch_one(self, query, values=None):
+        # inserts with RETURNING
+        if self.read_your_writes and is_write(query):
+            return self._marked(super().fetch_one(query, values))
+        return super().fetch_one(query, values)
+
+
+class _WriterTransaction(Transaction):
+
+    def __init__(self, database, connection_callable, **kwargs):
+        super().__init__(connection_callable, **kwargs)
+        self._database = database
+
+    async def commit(self):
+        await super().commit()
+        self._database.mark_write()
+
+
+def is_write(query):
+    """Whether query is an INSERT, UPDATE or DELETE, or a statement
+    tagged as writing rows"""
+    if isinstance(query, BoundStatement):
+        compiled = query._compiled
+        return (query.writes or compiled.isinsert or compiled.isupdate or
+                compiled.isdelete)
+    return getattr(query, "is_dml", False)
@@ -0,0 +1,119 @@
+"""Unit of work for OMDatabase.
+
+    async with db.session() as session:
+        session.add(a, b)
+        session.update(c)
+        session.remove(d)
+    # flushed here, in one transaction
+
+Pending writes are sent on flush() with the batched helpers of `om`,
+models ordered by their foreign keys: inserts and updates parents first,
+deletes children first. Queries don't see pending writes until they are
+flushed, and foreign key values must be set before flush (generated keys
+are only known after it).
+"""
+
+from sqlalchemy.util import topological
+
+from .om import delete_many, insert_many, update_many
+
+
+class Session:
+
+    def __init__(self, database, batch_size=500):
+        self.database = database
+        self.batch_size = batch_size
+        # by id(), keeping the order they were queued in
+        self._new = {}
+        self._dirty = {}
+        self._deleted = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.flush()
+        else:
+            self.clear()
+
+    def __len__(self):
+        return len(self._new) + len(self._dirty) + len(self._deleted)
+
+    def add(self, *instances):
+        for ins in instances:
+            self._deleted.pop(id(ins), None)
+            self._new[id(ins)] = ins
+
+    def update(self, *instances):
+        for ins in instances:
+            if id(ins) not in self._new:
+                self._dirty[id(ins)] = ins
+
+    def remove(self, *instances):
+        for ins in instances:
+            if self._new.pop(id(ins), None) is not None:
+                # never sent, nothing to delete
+                continue
+            self._dirty.pop(id(ins), None)
+            self._deleted[id(ins)] = ins
+
+    delete = remove
+
+    def clear(self):
+        """Discards the pending writes"""
+        self._new.clear()
+        self._dirty.clear()
+        self._deleted.clear()
+
+    async def flush(self):
+        """Sends the pending writes in one transaction"""
+        if not len(self):
+            return
+        new = sort_instances(self._new.values())
+        dirty = sort_instances(self._dirty.values())
+        deleted = sort_instances(self._deleted.values())
+        deleted.reverse()
+        db = self.database
+        async with db.transaction():
+            if new:
+                await insert_many(new, db, batch_size=self.batch_size)
+            if dirty:
+                await update_many(dirty, db, batch_size=self.batch_size)
+            if deleted:
+                await delete_many(deleted, db, chunk_size=self.batch_size)
+        self.clear()
+
+        identity_map = db.get_identity_map()
+        if identity_map is not None:
+            for ins in new + dirty:
+                identity_map.replace(ins)
+            for ins in deleted:
+                identity_map.discard(ins)
+
+
+def sort_instances(instances):
+    """Instances grouped by mapper, mappers after the ones their tables
+    have foreign keys to"""
+    groups = {}
+    for ins in instances:
+        groups.setdefault(ins.__mapper__, []).append(ins)
+    if len(groups) < 2:
+        return [ins for group in groups.values() for ins in group]
+
+    owners = {}
+    for mapper in groups:
+        for table in mapper.tables:
+            owners.setdefault(table, []).append(mapper)
+    dependencies = set()
+    for mapper in groups:
+        for table in mapper.tables:
+            for fk in table.foreign_keys:
+                for parent in owners.get(fk.column.table, ()):
+                    if parent is not mapper:
+                        dependencies.add((parent, mapper))
+    return [
+        ins for mapper in topological.sort(
+            dependencies, list(groups), deterministic_order=True)
+        for ins in groups[mapper]
+    ]
@@ -1,9 +1,13 @@
+import asyncio
 
 import pytest
 from sqlalchemy.ext.declarative import declarative_base
 import sqlalchemy as sa
-from asyncom import OMBase
+from asyncom import OMBase, OMDatabase
+from sqlalchemy.exc import InvalidRequestError
 from sqlalchemy.orm import exc as orm_exc
+from asyncom.om import UnloadedAttributeError
+from asyncom.instrumentation import Aggregator, Hook, SlowQueryLog
 
 Base = declarative_base(cls=OMBase)
 
@@ -190,3 +194,564 @@ async def test_multiple_primary_keys(async_db, data):
         OrmTestMultiPKey.key2 == 'key2').one()
 
     await async_db.update(ob)
+
+
+@pytest.mark.asyncio
+async def test_add_all(async_db, data):
+    items = [OrmTest(name=f"test{i}", value="xxx") for i in range(25)]
+    items.append(OrmTest(id=1000, name="provided"))
+    await async_db.add_all(items, batch_size=10)
+    assert all(item.id is not None for item in items)
+    assert len({item.id for item in items}) == 26
+    assert await async_db.query(OrmTest).count() == 26
+    res = await async_db.query(OrmTest).get(items[7].id)
+    assert res.name == "test7"
+    res = await async_db.query(OrmTest).get(1000)
+    assert res.name == "provided"
+    assert res.value is None
+
+    await async_db.add_all([
+        OrmTestMultiPKey(key1="a", key2="b"),
+        OrmTestMultiPKey(key1="a", key2="c"),
+    ])
+    assert await async_db.query(OrmTestMultiPKey).count() == 2
+
+
+@pytest.mark.asyncio
+async def test_update_only_writes_changes(async_db, data):
+    ins = OrmTest(name="test", value="xxx")
+    await async_db.add(ins)
+
+    async def touch():
+        await async_db.execute(OrmTest.__table__.update().where(
+            OrmTest.id == ins.id).values(value="changed"))
+
+    reg = await async_db.query(OrmTest).get(ins.id)
+    await touch()
+    reg.name = "test2"
+    await async_db.update(reg)
+    res = await async_db.query(OrmTest).get(ins.id)
+    assert res.name == "test2"
+    assert res.value == "changed"
+
+    # no changes, no statement
+    await async_db.execute(OrmTest.__table__.update().values(value="x"))
+    await async_db.update(res)
+    res = await async_db.query(OrmTest).get(ins.id)
+    assert res.value == "x"
+
+    # changes after an insert are tracked too
+    ins.value = "yyy"
+    await async_db.update(ins)
+    res = await async_db.query(OrmTest).get(ins.id)
+    assert res.name == "test2"
+    assert res.value == "yyy"
+
+
+@pytest.mark.asyncio
+async def test_get_many(async_db, data):
+    items = [OrmTest(name=f"test{i}") for i in range(10)]
+    await async_db.add_all(items)
+    ids = [items[5].id, 1000, items[1].id, items[5].id]
+    res = await async_db.query(OrmTest).get_many(ids, chunk_size=2)
+    assert [r and r.name for r in res] == ["test5", None, "test1", "test5"]
+
+    await async_db.add_all([
+        OrmTestMultiPKey(key1="a", key2="b"),
+        OrmTestMultiPKey(key1="a", key2="c"),
+    ])
+    res = await async_db.query(OrmTestMultiPKey).get_many(
+        [("a", "c"), ("b", "b"), ("a", "b")])
+    assert [r and r.key2 for r in res] == ["c", None, "b"]
+    res = await async_db.query(OrmTestMultiPKey).get(("a", "c"))
+    assert res.key2 == "c"
+
+
+@pytest.mark.asyncio
+async def test_loader_batches_gets(async_db, data):
+    items = [OrmTest(name=f"test{i}") for i in range(3)]
+    await async_db.add_all(items)
+    queries = []
+    fetch_all = async_db.fetch_all
+
+    async def counted(*args, **kwargs):
+        queries.append(args)
+        return await fetch_all(*args, **kwargs)
+
+    async_db.fetch_all = counted
+    try:
+        loader = async_db.loader(OrmTest)
+        res = await asyncio.gather(
+            loader.get(items[2].id), loader.get(items[0].id), loader.get(0))
+    finally:
+        del async_db.fetch_all
+    assert [r and r.name for r in res] == ["test2", "test0", None]
+    assert len(queries) == 1
+
+
+@pytest.mark.asyncio
+async def test_loader_keeps_transactions_apart(tmp_path):
+    url = f"sqlite:///{tmp_path / 'loader.db'}"
+    OrmTest.__table__.create(sa.create_engine(url))
+    db = OMDatabase(url)
+    await db.connect()
+    loader = db.loader(OrmTest)
+    added = asyncio.Event()
+
+    async def in_transaction():
+        transaction = await db.transaction().start()
+        try:
+            await db.add(OrmTest(id=1, name="uncommitted"))
+            added.set()
+            return await loader.get(1)
+        finally:
+            await transaction.rollback()
+
+    async def outside():
+        await added.wait()
+        return await loader.get(1)
+
+    try:
+        mine, other = await db.gather(in_transaction(), outside())
+    finally:
+        await db.disconnect()
+    assert mine.name == "uncommitted"
+    assert other is None
+
+
+@pytest.mark.asyncio
+async def test_identity_map(async_db, data):
+    ins = OrmTest(name="test", value="xxx")
+    ins2 = OrmTest(name="test2", value="xxx")
+    await async_db.add(ins, ins2)
+    assert await async_db.query(OrmTest).get(ins.id) is not ins
+
+    with async_db.identity_map() as identity_map:
+        res = await async_db.query(OrmTest).order_by(OrmTest.id).all()
+        assert len(identity_map) == 2
+        assert await async_db.query(OrmTest).get(ins.id) is res[0]
+        assert [r async for r in async_db.query(OrmTest)][1] is res[1]
+        many = await async_db.query(OrmTest).get_many([ins2.id, ins.id])
+        assert many == [res[1], res[0]]
+
+        await async_db.remove(res[0])
+        assert await async_db.query(OrmTest).get(ins.id) is None
+
+        ins3 = OrmTest(name="test3")
+        await async_db.add(ins3)
+        assert await async_db.query(OrmTest).get(ins3.id) is ins3
+
+        await async_db.query(OrmTest).delete()
+        assert len(identity_map) == 0
+        assert await async_db.query(OrmTest).get(ins3.id) is None
+
+    assert async_db.get_identity_map() is None
+
+
+@pytest.mark.asyncio
+async def test_iter_chunks(async_db, data):
+    await async_db.add_all([OrmTest(name=f"test{i:02}") for i in range(25)])
+    chunks = [
+        chunk async for chunk in async_db.query(OrmTest).filter(
+            OrmTest.name != "test03").iter_chunks(10)
+    ]
+    assert [len(chunk) for chunk in chunks] == [10, 10, 4]
+    ids = [item.id for chunk in chunks for item in chunk]
+    assert ids == sorted(ids)
+
+    names = []
+    async for chunk in async_db.query(OrmTest).iter_chunks(
+            7, key=OrmTest.name, after="test19"):
+        names.extend(item.name for item in chunk)
+    assert names == [f"test{i}" for i in range(20, 25)]
+
+    await async_db.add_all([
+        OrmTestMultiPKey(key1=k1, key2=k2) for k1 in "ab" for k2 in "xyz"])
+    keys = [
+        (item.key1, item.key2)
+        async for chunk in async_db.query(OrmTestMultiPKey).iter_chunks(4)
+        for item in chunk
+    ]
+    assert keys == [(k1, k2) for k1 in "ab" for k2 in "xyz"]
+
+    with pytest.raises(InvalidRequestError):
+        async for chunk in async_db.query(OrmTest).limit(5).iter_chunks(2):
+            pass
+
+
+@pytest.mark.asyncio
+async def test_iterate_batches(async_db, data):
+    await async_db.add_all([OrmTest(name=f"test{i:02}") for i in range(25)])
+    q = async_db.query(OrmTest).order_by(OrmTest.id)
+
+    sizes = [len(batch) async for batch in q.iterate_batches(10)]
+    assert sizes == [10, 10, 5]
+    sizes = [len(batch) async for batch in q.iterate_batches(5, buffer=0)]
+    assert sizes == [5] * 5
+    names = [item.name async for item in q.iterate(batch_size=7)]
+    assert names == [f"test{i:02}" for i in range(25)]
+
+    fetched = []
+    iterate_batches = async_db.iterate_batches
+
+    async def counting(*args, **kwargs):
+        batches = iterate_batches(*args, **kwargs)
+        try:
+            async for batch in batches:
+                fetched.append(len(batch))
+                yield batch
+        finally:
+            await batches.aclose()
+
+    async_db.iterate_batches = counting
+    try:
+        batches = q.iterate_batches(2, buffer=2)
+        await batches.__anext__()
+        await asyncio.sleep(0.05)
+        # the consumed batch, the two buffered and one waiting to be put
+        assert len(fetched) == 4
+        await batches.aclose()
+    finally:
+        del async_db.iterate_batches
+
+
+@pytest.mark.asyncio
+async def test_count_is_a_direct_aggregate(async_db, data):
+    await async_db.add_all([OrmTest(name=f"test{i % 3}") for i in range(9)])
+    statements = []
+    fetch_val = async_db.fetch_val
+
+    async def recording(query, *args, **kwargs):
+        statements.append(str(query))
+        return await fetch_val(query, *args, **kwargs)
+
+    async_db.fetch_val = recording
+    try:
+        q = async_db.query(OrmTest).filter(OrmTest.name == "test1")
+        assert await q.count() == 3
+        assert await q.order_by(OrmTest.id).count() == 3
+        assert "FROM (SELECT" not in statements[-1]
+        assert "ORDER BY" not in statements[-1]
+
+        assert await async_db.query(OrmTest).limit(4).count() == 4
+        assert "FROM (SELECT" in statements[-1]
+        assert await async_db.query(OrmTest.name).distinct().count() == 3
+
+        estimate = await q.count(estimate=True)
+        assert isinstance(estimate, int)
+        assert statements[-1].startswith("EXPLAIN")
+    finally:
+        del async_db.fetch_val
+
+
+@pytest.mark.asyncio
+async def test_only_and_defer(async_db, data):
+    await async_db.add(OrmTest(name="test", value="x" * 1000))
+    res = await async_db.query(OrmTest).only("name").one()
+    assert res.name == "test"
+    with pytest.raises(UnloadedAttributeError):
+        res.value
+    await async_db.load(res)
+    assert res.value == "x" * 1000
+
+    res = await async_db.query(OrmTest).defer(OrmTest.value).one()
+    assert res.name == "test"
+    res.name = "changed"
+    await async_db.update(res)
+    res = await async_db.query(OrmTest).defer(
+        OrmTest.value, unloaded="lazy").one()
+    assert res.name == "changed"
+    assert await res.value == "x" * 1000
+    assert res.value == "x" * 1000
+
+    with pytest.raises(ValueError):
+        async_db.query(OrmTest).only("name", unloaded="ignore")
+
+
+@pytest.mark.asyncio
+async def test_tuples_dicts_and_columns(async_db, data):
+    await async_db.add(
+        OrmTest(name="a", value="1"),
+        OrmTest(name="b", value="2"),
+    )
+    q = async_db.query(OrmTest).order_by(OrmTest.name)
+    rows = await q.tuples()
+    assert [row[1:] for row in rows] == [("a", "1"), ("b", "2")]
+    rows = await q.dicts()
+    assert [(row["name"], row["value"]) for row in rows] == [
+        ("a", "1"), ("b", "2")]
+    assert set(rows[0]) == {"id", "name", "value"}
+
+    cols = await q.columns(arrays=False)
+    assert cols["name"] == ["a", "b"]
+    assert cols["value"] == ["1", "2"]
+    cols = await q.filter(OrmTest.name == "c").columns(arrays=False)
+    assert cols == {"id": [], "name": [], "value": []}
+
+
+@pytest.mark.asyncio
+async def test_columns_as_arrays(async_db, data):
+    numpy = pytest.importorskip("numpy")
+    await async_db.add(OrmTest(name="a"), OrmTest(name="b"))
+    cols = await async_db.query(OrmTest).order_by(OrmTest.name).columns()
+    assert isinstance(cols["id"], numpy.ndarray)
+    assert list(cols["name"]) == ["a", "b"]
+
+
+@pytest.mark.asyncio
+async def test_prefetch(async_db, data):
+    parents = [OrmTest(name=f"parent{i}") for i in range(3)]
+    await async_db.add_all(parents)
+    await async_db.add_all([
+        ManyTests(id_orm=parent.id, other=f"{parent.name}-{i}")
+        for parent in parents[:2] for i in range(2)
+    ])
+    queries = []
+    fetch_all = async_db.fetch_all
+
+    async def recording(query, *args, **kwargs):
+        queries.append(query)
+        return await fetch_all(query, *args, **kwargs)
+
+    async_db.fetch_all = recording
+    try:
+        res = await async_db.query(OrmTest).order_by(OrmTest.id).prefetch(
+            ManyTests, attr="children").all()
+        assert len(queries) == 2
+        assert [[c.other for c in r.children] for r in res] == [
+            ["parent0-0", "parent0-1"], ["parent1-0", "parent1-1"], []]
+
+        res = await async_db.query(ManyTests).prefetch(
+            OrmTest, fk=ManyTests.id_orm, attr="parent").all()
+        assert len(queries) == 4
+        assert {(r.other, r.parent.name) for r in res} == {
+            ("parent0-0", "parent0"), ("parent0-1", "parent0"),
+            ("parent1-0", "parent1"), ("parent1-1", "parent1")}
+
+        res = await async_db.query(OrmTest).prefetch(
+            ManyTests, attr="children",
+            query=async_db.query(ManyTests).filter(
+                ManyTests.other.like("%-1"))).get(parents[0].id)
+        assert [c.other for c in res.children] == ["parent0-1"]
+    finally:
+        del async_db.fetch_all
+
+    with pytest.raises(ValueError):
+        async_db.query(OrmTest).prefetch(ManyTests, attr="name")
+    with pytest.raises(ValueError):
+        async_db.query(OrmTest).prefetch(OrmTestMultiPKey, attr="keys")
+
+
+@pytest.mark.asyncio
+async def test_upsert(async_db, data):
+    existing = OrmTest(name="a", value="1")
+    await async_db.add(existing)
+
+    ins = await async_db.upsert(OrmTest(id=existing.id, name="b"))
+    assert (ins.id, ins.name, ins.value) == (existing.id, "b", None)
+    res = await async_db.query(OrmTest).get(existing.id)
+    assert (res.name, res.value) == ("b", None)
+
+    rows = [
+        OrmTest(id=existing.id, name="c", value="2"),
+        OrmTest(id=existing.id + 100, name="d", value="3"),
+        OrmTest(id=existing.id, name="e", value="4"),
+    ]
+    await async_db.upsert(rows, conflict_cols=[OrmTest.id],
+                          update_cols=["value"])
+    # name is not updated, the instances get the values on the table
+    assert [(r.name, r.value) for r in rows] == [
+        ("b", "2"), ("d", "3"), ("b", "4")]
+    res = await async_db.query(OrmTest).order_by(OrmTest.id).all()
+    assert [(r.name, r.value) for r in res] == [("b", "4"), ("d", "3")]
+
+    keys = [OrmTestMultiPKey(key1="a", key2=k) for k in "xy"]
+    await async_db.upsert(keys)
+    await async_db.upsert(keys + [OrmTestMultiPKey(key1="a", key2="z")])
+    assert await async_db.query(OrmTestMultiPKey).count() == 3
+
+    with pytest.raises(ValueError):
+        await async_db.upsert(OrmTest(name="no key"))
+
+
+@pytest.mark.asyncio
+async def test_bulk_update_and_remove(async_db, data):
+    rows = [OrmTest(name=f"test{i}", value="old") for i in range(10)]
+    await async_db.add_all(rows)
+
+    await async_db.query(OrmTest).filter(
+        OrmTest.id.in_([r.id for r in rows[:3]])).update({"value": "set"})
+    res = await async_db.query(OrmTest).filter_by(value="set").count()
+    assert res == 3
+
+    for row in rows[3:6]:
+        row.value = f"new {row.name}"
+    rows[6].name = "renamed"
+    await async_db.update_many(rows)
+    res = await async_db.query(OrmTest).order_by(OrmTest.id).all()
+    assert [r.value for r in res[3:7]] == [
+        "new test3", "new test4", "new test5", "old"]
+    assert res[6].name == "renamed"
+
+    await async_db.remove_many(rows[:8], chunk_size=3)
+    res = await async_db.query(OrmTest).order_by(OrmTest.id).all()
+    assert [r.name for r in res] == ["test8", "test9"]
+
+
+@pytest.mark.asyncio
+async def test_session(async_db, data):
+    existing = [OrmTest(name=f"old{i}") for i in range(3)]
+    await async_db.add_all(existing)
+    start = max(ins.id for ins in existing) + 1
+
+    async with async_db.session() as session:
+        # children first, flush orders them after their parents
+        session.add(*[
+            ManyTests(id_orm=start + i, other=str(i)) for i in range(4)])
+        session.add(*[
+            OrmTest(id=start + i, name=f"new{i}") for i in range(4)])
+        existing[0].name = "changed"
+        session.update(existing[0])
+        session.remove(existing[1])
+        discarded = OrmTest(name="discarded")
+        session.add(discarded)
+        session.remove(discarded)
+        assert await async_db.query(OrmTest).count() == 3
+
+    res = await async_db.query(OrmTest).order_by(OrmTest.id).all()
+    assert [r.name for r in res] == [
+        "changed", "old2", "new0", "new1", "new2", "new3"]
+    assert await async_db.query(ManyTests).count() == 4
+
+    with pytest.raises(RuntimeError):
+        async with async_db.session() as session:
+            session.add(OrmTest(name="never"))
+            raise RuntimeError()
+    assert await async_db.query(OrmTest).filter_by(name="never").count() == 0
+
+
+class RecordingHook(Hook):
+    def __init__(self):
+        self.events = []
+
+    def before_execute(self, event):
+        self.events.append(("before", event.phase, event.fingerprint))
+
+    def after_compile(self, event):
+        self.events.append(event)
+
+    after_execute = after_map = after_compile
+
+
+@pytest.mark.asyncio
+async def test_instrumentation(async_db, data):
+    hook = RecordingHook()
+    aggregator = Aggregator()
+    slow = SlowQueryLog(threshold=0)
+    for h in (hook, aggregator, slow):
+        async_db.instrumentation.add(h)
+    try:
+        await async_db.add_all([OrmTest(name=f"ins{i}") for i in range(3)])
+        ins = await async_db.query(OrmTest).filter(
+            OrmTest.name == "ins1").one()
+        ins.value = "changed"
+        await async_db.update(ins)
+        for _ in range(2):
+            assert len(await async_db.query(OrmTest).all()) == 3
+        assert len([
+            row async for row in async_db.query(OrmTest).no_cache()]) == 3
+        assert await async_db.query(OrmTest).count() == 3
+        await async_db.execute("SELECT 1")
+    finally:
+        for h in (hook, aggregator, slow):
+            async_db.instrumentation.remove(h)
+
+    events = [e for e in hook.events if not isinstance(e, tuple)]
+    assert {e.phase for e in events} == {"compile", "execute", "map"}
+    assert all(e.duration >= 0 for e in events)
+    maps = [e for e in events if e.phase == "map"]
+    assert [e.rows for e in maps] == [1, 3, 3, 3]
+    assert all(e.entity is OrmTest for e in maps)
+    assert all(e.fingerprint for e in maps)
+
+    # all() and the cursor share a fingerprint, rows are counted
+    executes = [e for e in events if e.phase == "execute"]
+    select_all = [e for e in executes if e.rows == 3 and
+                  e.fingerprint == maps[1].fingerprint]
+    assert len(select_all) == 3
+    assert select_all[0].entity is OrmTest
+    assert ("before", "execute", select_all[0].fingerprint) in hook.events
+
+    stats = {s.fingerprint: s for s in aggregator.stats("execute")}
+    stat = stats[maps[1].fingerprint]
+    assert stat.count == 3
+    assert stat.p50 <= stat.p99 <= stat.max
+    assert "FROM orm_test" in stat.sql
+    assert {s.phase for s in aggregator.stats()} == {
+        "compile", "execute", "map"}
+    assert len(slow.entries) == len(executes)
+
+    hook.events.clear()
+    await async_db.query(OrmTest).all()
+    assert hook.events == []
+
+
+@pytest.mark.asyncio
+async def test_instrumented_execute_many(tmp_path):
+    url = f"sqlite:///{tmp_path / 'hooks.db'}"
+    OrmTest.__table__.create(sa.create_engine(url))
+    aggregator = Aggregator()
+    db = OMDatabase(url, hooks=[aggregator])
+    await db.connect()
+    try:
+        await db.execute_many(OrmTest.__table__.insert(), [
+            {"name": "many0"}, {"name": "many1"}])
+        # no COPY on sqlite, it falls back to execute_many
+        assert await db.copy_into(OrmTest, [
+            {"name": "copy0"}, OrmTest(name="copy1")]) == 2
+        assert await db.query(OrmTest).count() == 4
+    finally:
+        await db.disconnect()
+    assert any("INSERT INTO orm_test" in stat.sql
+               for stat in aggregator.stats("execute"))
+
+
+@pytest.mark.asyncio
+async def test_gather(async_db, data):
+    await async_db.add_all([OrmTest(name=f"gather{i}") for i in range(3)])
+    q = async_db.query(OrmTest).filter(OrmTest.name.like("gather%"))
+    first = (await q.order_by(OrmTest.id).all())[0]
+
+    # force_rollback, serial on the shared connection
+    count, page, ins = await async_db.gather(
+        q.count(), q.order_by(OrmTest.id).limit(2), q.get(first.id))
+    assert count == 3
+    assert [r.name for r in page] == ["gather0", "gather1"]
+    assert ins.name == "gather0"
+
+    with pytest.raises(orm_exc.NoResultFound):
+        await async_db.gather(q.count(), q.filter_by(name="none").one())
+
+
+@pytest.mark.asyncio
+async def test_gather_uses_a_connection_per_query(async_db, data):
+    if async_db.dialect.name != "postgresql":
+        pytest.skip("needs a backend pid")
+    db = OMDatabase(async_db.url)
+    await db.connect()
+    try:
+        pid = "SELECT pg_backend_pid() FROM pg_sleep(0.1)"
+        # a connection already bound to the task is not shared
+        await db.fetch_val(pid)
+        pids = await db.gather(*[db.fetch_val(pid) for _ in range(3)])
+        assert len(set(pids)) == 3
+        pids = await db.gather(
+            *[db.fetch_val(pid) for _ in range(3)], max_concurrency=1)
+        assert len(set(pids)) == 1
+        async with db.transaction():
+            pids = await db.gather(*[db.fetch_val(pid) for _ in range(3)])
+            assert len(set(pids)) == 1
+        assert await db.gather(
+            db.query(OrmTest).count(), db.query(OrmTest)) == [0, []]
+    finally:
+        await db.disconnect()
@@ -0,0 +1,133 @@
+import pytest
+from sqlalchemy.ext.declarative import declarative_base
+import sqlalchemy as sa
+from asyncom import OMBase, OMDatabase
+from asyncom.prepared import PreparedStatements
+
+Base = declarative_base(cls=OMBase)
+
+pytestmark = pytest.mark.asyncio
+
+
+class CacheTest(Base):
+    __tablename__ = 'cache_test'
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(100), index=True)
+
+
+@pytest.fixture
+async def data(async_db):
+    url = str(async_db.url)
+    engine = sa.create_engine(url)
+    Base.metadata.create_all(engine)
+    await async_db.add(
+        CacheTest(id=1, name="one"),
+        CacheTest(id=2, name="two"),
+        CacheTest(id=3, name="three"),
+    )
+    async_db.statement_cache.clear()
+
+
+async def test_same_shape_is_compiled_once(async_db, data):
+    cache = async_db.statement_cache
+    one = await async_db.query(CacheTest).get(1)
+    assert cache.info().misses == 1
+    two = await async_db.query(CacheTest).get(2)
+    assert cache.info().hits == 1
+    assert one.name == "one"
+    assert two.name == "two"
+
+    res = await async_db.query(CacheTest).filter(
+        CacheTest.name.in_(["one", "two"])).order_by(CacheTest.id).all()
+    assert [r.id for r in res] == [1, 2]
+    res = await async_db.query(CacheTest).filter(
+        CacheTest.name.in_(["two", "three"])).order_by(CacheTest.id).all()
+    assert [r.id for r in res] == [2, 3]
+
+
+async def test_limit_and_count_are_rebound(async_db, data):
+    cache = async_db.statement_cache
+    q = async_db.query(CacheTest).order_by(CacheTest.id)
+    assert len(await q.limit(1).all()) == 1
+    assert len(await q.limit(2).all()) == 2
+    assert (cache.info().hits, cache.info().misses) == (1, 1)
+    assert await q.filter(CacheTest.id > 1).count() == 2
+    assert await q.filter(CacheTest.id > 2).count() == 1
+    assert (cache.info().hits, cache.info().misses) == (2, 2)
+    assert [r.id async for r in q.offset(1)] == [2, 3]
+    assert [r.id async for r in q.offset(2)] == [3]
+    assert (cache.info().hits, cache.info().misses) == (3, 3)
+
+
+async def test_cache_can_be_disabled_per_query(async_db, data):
+    cache = async_db.statement_cache
+    res = await async_db.query(CacheTest, cache=False).get(1)
+    assert res.name == "one"
+    res = await async_db.query(CacheTest).no_cache().get(2)
+    assert res.name == "two"
+    assert cache.info() == (0, 0, cache.maxsize, 0)
+
+
+async def test_cache_is_bounded(async_db, data):
+    cache = async_db.statement_cache
+    maxsize = cache.maxsize
+    cache.maxsize = 2
+    try:
+        await async_db.query(CacheTest).get(1)
+        await async_db.query(CacheTest).filter_by(name="one").all()
+        await async_db.query(CacheTest).order_by(CacheTest.name).all()
+        assert len(cache) == 2
+        await async_db.query(CacheTest).get(1)
+        assert cache.info().misses == 4
+    finally:
+        cache.maxsize = maxsize
+
+
+async def test_prepared_statements(async_db, data):
+    if async_db.dialect.name != "postgresql":
+        pytest.skip("prepared statements are only used on postgres")
+    async_db.prepared_statements = prepared = PreparedStatements(2)
+    try:
+        for i in (1, 2, 3):
+            res = await async_db.query(CacheTest).get(i)
+            assert res.id == i
+        assert prepared.info().misses == 1
+        assert prepared.info().hits == 2
+
+        q = async_db.query(CacheTest).filter(CacheTest.id > 1)
+        assert await q.count() == 2
+        assert [r.id for r in await q.order_by(CacheTest.id).all()] == [2, 3]
+        assert await async_db.query(CacheTest).filter(
+            CacheTest.id > 2).count() == 1
+        # the get, count and all() shapes, on a LRU of two
+        assert prepared.info().misses == 3
+        assert prepared.info().hits == 3
+        assert prepared.info().currsize == 2
+
+        # uncached queries keep the text path
+        await async_db.query(CacheTest, cache=False).get(1)
+        async with async_db.transaction():
+            assert (await async_db.query(CacheTest).get(2)).name == "two"
+        assert prepared.info().misses == 4
+    finally:
+        async_db.prepared_statements = PreparedStatements()
+
+
+async def test_prepared_statements_outlive_checkouts(async_db, data):
+    if async_db.dialect.name != "postgresql":
+        pytest.skip("prepared statements are only used on postgres")
+    # no force_rollback, each query checks a connection out of the pool
+    db = OMDatabase(async_db.url, prepared_statements=4,
+                    min_size=1, max_size=1)
+    await db.connect()
+    try:
+        await db.add(CacheTest(id=100, name="pooled"))
+        for _ in range(3):
+            assert (await db.query(CacheTest).get(100)).name == "pooled"
+        assert db.prepared_statements.info().misses == 1
+        assert db.prepared_statements.info().hits == 2
+    finally:
+        await db.execute(CacheTest.__table__.delete().where(
+            CacheTest.id == 100))
+        await db.disconnect()
@@ -30,6 +30,14 @@ class DefaultValues(Base):
     name4 = sa.Column(sa.Integer, default=my_counter, onupdate=my_counter)
 
 
+class ServerDefaults(Base):
+    __tablename__ = "server_defaults"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(20), server_default="server")
+    created = sa.Column(sa.DateTime, server_default=sa.func.now())
+
+
 @pytest.fixture
 async def data(async_db):
     url = str(async_db.url)
@@ -51,3 +59,17 @@ async def test_ensure_default_values_on_insert(async_db, data):
     delattr(item, "name4")
     await async_db.update(item)
     assert item.name4 == 2
+
+
+@pytest.mark.asyncio
+async def test_server_defaults_are_returned(async_db, data):
+    item = ServerDefaults()
+    await async_db.add(item)
+    assert item.id is not None
+    assert item.name == "server"
+    assert item.created is not None
+
+    items = [ServerDefaults(name="given"), ServerDefaults()]
+    await async_db.add_all(items)
+    assert [i.name for i in items] == ["given", "server"]
+    assert all(i.created is not None for i in items)
@@ -6,6 +6,7 @@ import sqlalchemy as sa
 from sqlalchemy.ext.declarative import declarative_base
 
 from asyncom import OMBase
+from asyncom.plans import mapper_plan
 
 Base = declarative_base(cls=OMBase)
 
@@ -91,3 +92,160 @@ async def test_operate_with_abstract_class(db):
     await db.update(res)
     r2 = await db.query(Concrete).get(conc.id)
     assert r2.key == 'b'
+
+
+@pytest.mark.asyncio
+async def test_add_all_inherited(db):
+    data = datetime.datetime.now()
+    items = [Published(key=str(i), val='v', date=data) for i in range(10)]
+    await db.add_all(items, batch_size=3)
+    for item in items:
+        assert item.id is not None
+        assert item.element_id == item.id
+    res = await db.query(Published).get(items[4].id)
+    assert res.key == '4'
+    assert res.date == data
+    assert len(await db.query(Published).all()) == 10
+
+
+@pytest.mark.asyncio
+async def test_copy_into_inherited(db):
+    data = datetime.datetime.now()
+    await db.copy_into(Published, [
+        {'id': 100, 'key': 'a', 'date': data},
+        Published(id=101, key='b', date=data),
+    ])
+    res = await db.query(Published).get(100)
+    assert res.key == 'a'
+    assert res.date == data
+    res = await db.query(Published).get(101)
+    assert res.element_id == 101
+
+    with pytest.raises(ValueError):
+        await db.copy_into(Published, [Published(key='c')])
+
+
+@pytest.mark.asyncio
+async def test_update_skips_unchanged_tables(db):
+    data = datetime.datetime.now()
+    ele = Published(key='a', val='1', date=data)
+    await db.add(ele)
+    inherit = await db.query(Published).get(ele.id)
+    other = datetime.datetime(2000, 1, 1)
+    await db.execute(Published.__table__.update().values(date=other))
+    inherit.key = 'b'
+    await db.update(inherit)
+    n = await db.query(Published).get(ele.id)
+    assert n.key == 'b'
+    assert n.date == other
+
+
+@pytest.mark.asyncio
+async def test_count_inherited(db):
+    date = datetime.datetime.now()
+    await db.add_all([
+        Published(key=f'count{i}', val=str(i % 2), date=date)
+        for i in range(6)
+    ])
+    await db.add(Element(key='count', val='1'))
+    assert await db.query(Published).filter(
+        Published.key.like('count%')).count() == 6
+    assert await db.query(Published).filter(
+        Published.val == '1', Published.date == date).count() == 3
+    assert await db.query(Element).filter(
+        Element.key.like('count%')).count() == 7
+
+
+@pytest.mark.asyncio
+async def test_bulk_update_and_remove_inherited(db):
+    date = datetime.datetime.now()
+    items = [
+        Published(key=f'bulk{i}', val='old', date=date) for i in range(4)]
+    await db.add_all(items)
+
+    await db.query(Published).filter(
+        Published.key.in_(['bulk0', 'bulk1'])).update({
+            Published.val: 'set', 'date': None})
+    res = await db.query(Published).filter(
+        Published.key.like('bulk%')).order_by(Published.key).all()
+    assert [(r.val, r.date) for r in res] == [
+        ('set', None), ('set', None), ('old', date), ('old', date)]
+
+    res[2].val = 'new'
+    res[3].date = None
+    await db.update_many(res)
+    res = await db.query(Published).filter(
+        Published.key.like('bulk%')).order_by(Published.key).all()
+    assert [(r.val, r.date) for r in res[2:]] == [
+        ('new', date), ('old', None)]
+
+    await db.remove_many(res[:3])
+    assert await db.query(Published).filter(
+        Published.key.like('bulk%')).count() == 1
+    assert await db.query(Element).filter(
+        Element.key.like('bulk%')).count() == 1
+
+
+@pytest.mark.asyncio
+async def test_bulk_update_of_filtered_columns(db):
+    date = datetime.datetime.now()
+    await db.add_all([
+        Published(key='filtered0', val='old', date=date),
+        Published(key='filtered1', val='old', date=None)])
+
+    await db.query(Published).filter(Published.key == 'filtered0').update({
+        Published.key: 'filtered0b', 'date': None})
+    await db.query(Published).filter(Published.date.is_(None)).filter(
+        Published.key.like('filtered%')).update({
+            'date': date, 'val': 'changed'})
+    res = await db.query(Published).filter(
+        Published.key.like('filtered%')).order_by(Published.key).all()
+    assert [(r.key, r.val, r.date) for r in res] == [
+        ('filtered0b', 'changed', date), ('filtered1', 'changed', date)]
+
+
+@pytest.mark.asyncio
+async def test_insert_is_a_single_statement(db):
+    calls = []
+    fetch_one, execute = db.fetch_one, db.execute
+
+    async def recording_fetch_one(query, *args, **kwargs):
+        calls.append(query)
+        return await fetch_one(query, *args, **kwargs)
+
+    async def recording_execute(query, *args, **kwargs):
+        calls.append(query)
+        return await execute(query, *args, **kwargs)
+
+    db.fetch_one, db.execute = recording_fetch_one, recording_execute
+    try:
+        ele = Published(key='single', val='1')
+        await db.add(ele)
+    finally:
+        del db.fetch_one, db.execute
+    assert len(calls) == 1
+    assert ele.id is not None
+    assert ele.element_id == ele.id
+    res = await db.query(Published).get(ele.id)
+    assert (res.key, res.val, res.date) == ('single', '1', None)
+
+
+@pytest.mark.asyncio
+async def test_write_plans_are_reused(db):
+    plan = mapper_plan(Published.__mapper__)
+    assert mapper_plan(Published.__mapper__) is plan
+    for cache in [plan._statements] + [t._statements for t in plan.tables]:
+        cache.clear()
+    await db.add(Published(key='plan0', val='1'))
+    statements = len(plan._statements) + sum(
+        len(table._statements) for table in plan.tables)
+    ele = Published(key='plan1', val='2')
+    await db.add(ele)
+    ele.key = 'plan2'
+    await db.update(ele)
+    ele.key = 'plan3'
+    await db.update(ele)
+    assert len(plan._statements) + sum(
+        len(table._statements) for table in plan.tables) == statements + 1
+    res = await db.query(Published).get(ele.id)
+    assert (res.key, res.val, res.element_id) == ('plan3', '2', ele.id)
@@ -3,6 +3,7 @@ import enum
 import sqlalchemy as sa
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm.attributes import flag_modified
 
 from asyncom import OMBase
 
@@ -18,6 +19,12 @@ class OrmJSON(Base):
     value = sa.Column(JSONB)
 
 
+class OrmTrackedJSON(Base):
+    __tablename__ = "orm_json_tracked"
+    key = sa.Column(sa.String(254), primary_key=True)
+    value = sa.Column(JSONB, info={"mutable": True})
+
+
 class ColTypes(enum.Enum):
     typea = "a"
     typeb = "b"
@@ -65,3 +72,43 @@ async def test_enum(async_db, data):
     res = await async_db.query(OrmEnum).filter(
         OrmEnum.value == ColTypes.typea).one()
     assert res.key == "a"
+
+
+async def test_copy_into_processes_values(async_db, data):
+    await async_db.copy_into(OrmJSON, [
+        {"key": "a", "value": {"a": 1}},
+        OrmJSON(key="b", value=[1, 2]),
+    ])
+    await async_db.copy_into(OrmEnum, [OrmEnum(key="a", value=ColTypes.typeb)])
+    res = await async_db.query(OrmJSON).get("a")
+    assert res.value == {"a": 1}
+    res = await async_db.query(OrmJSON).get("b")
+    assert res.value == [1, 2]
+    res = await async_db.query(OrmEnum).get("a")
+    assert res.value == ColTypes.typeb
+
+
+async def test_json_changed_in_place(async_db, data):
+    await async_db.add(OrmJSON(key="prop", value={"a": 1}))
+    res = await async_db.query(OrmJSON).get("prop")
+    res.value["a"] = 2
+    flag_modified(res, "value")
+    await async_db.update(res)
+    res = await async_db.query(OrmJSON).get("prop")
+    assert res.value == {"a": 2}
+
+
+async def test_mutable_json_changed_in_place(async_db, data):
+    await async_db.add(OrmTrackedJSON(key="prop", value={"a": 1}))
+    res = await async_db.query(OrmTrackedJSON).get("prop")
+    res.value["a"] = 2
+    await async_db.update(res)
+    res = await async_db.query(OrmTrackedJSON).get("prop")
+    assert res.value == {"a": 2}
+
+    res.value["b"] = [1]
+    await async_db.update(res)
+    res.value["b"].append(2)
+    await async_db.update(res)
+    res = await async_db.query(OrmTrackedJSON).get("prop")
+    assert res.value == {"a": 2, "b": [1, 2]}
@@ -0,0 +1,108 @@
+import pytest
+from sqlalchemy.ext.declarative import declarative_base
+import sqlalchemy as sa
+from sqlalchemy import orm
+from asyncom import OMBase
+from asyncom.om import row_mapper
+
+Base = declarative_base(cls=OMBase)
+
+pytestmark = pytest.mark.asyncio
+
+
+class MapperTest(Base):
+    __tablename__ = 'mapper_test'
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(100))
+    value = sa.Column(sa.Text)
+
+    @property
+    def label(self):
+        return f"{self.name}: {self.value}"
+
+
+class CustomInit(Base):
+    __tablename__ = 'mapper_custom_init'
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(100))
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.initialized = True
+
+
+class Validated(Base):
+    __tablename__ = 'mapper_validated'
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(100))
+
+    @orm.validates('name')
+    def validate_name(self, key, value):
+        return value.upper()
+
+
+@pytest.fixture
+async def data(async_db):
+    url = str(async_db.url)
+    engine = sa.create_engine(url)
+    Base.metadata.create_all(engine)
+
+
+async def test_mapped_instances_match_constructed(async_db, data):
+    await async_db.add(
+        MapperTest(name="a", value="1"),
+        MapperTest(name="b", value=None),
+    )
+    res = await async_db.query(MapperTest).order_by(MapperTest.id).all()
+    assert [(r.id, r.name, r.value) for r in res] == [
+        (res[0].id, "a", "1"), (res[1].id, "b", None)]
+    assert isinstance(res[0], MapperTest)
+    res[0].name = "c"
+    await async_db.update(res[0])
+    assert (await async_db.query(MapperTest).get(res[0].id)).name == "c"
+
+
+async def test_mapper_is_built_once_per_layout(async_db, data):
+    row_mapper.cache_clear()
+    await async_db.query(MapperTest).all()
+    await async_db.query(MapperTest).filter_by(name="a").all()
+    assert row_mapper.cache_info().misses == 1
+    assert row_mapper.cache_info().hits == 1
+
+
+async def test_custom_constructor_is_called(async_db, data):
+    await async_db.add(CustomInit(name="a"))
+    res = await async_db.query(CustomInit).one()
+    assert res.initialized is True
+
+
+async def test_validators_are_called(async_db, data):
+    await async_db.execute(Validated.__table__.insert().values(name="a"))
+    res = await async_db.query(Validated).one()
+    assert res.name == "A"
+
+
+async def test_readonly_records(async_db, data):
+    await async_db.add(
+        MapperTest(name="a", value="1"),
+        MapperTest(name="b", value=None),
+    )
+    q = async_db.query(MapperTest).order_by(MapperTest.name)
+    res = await q.readonly().all()
+    assert [(r.name, r.value) for r in res] == [("a", "1"), ("b", None)]
+    assert not isinstance(res[0], MapperTest)
+    assert not hasattr(res[0], "__dict__")
+    assert type(res[0]) is type(res[1])
+    assert res[0].label == "a: 1"
+    assert res[0]._asdict() == {"id": res[0].id, "name": "a", "value": "1"}
+    with pytest.raises(AttributeError):
+        res[0].name = "c"
+
+    res = await q.readonly().only("name").all()
+    assert res[0].name == "a"
+    with pytest.raises(AttributeError):
+        res[0].value
+    assert [r.name async for r in q.readonly()] == ["a", "b"]
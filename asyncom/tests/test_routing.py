@@ -0,0 +1,166 @@
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declarative_base
+
+from asyncom import OMBase, RoutedDatabase
+from asyncom import routing
+
+Base = declarative_base(cls=OMBase)
+
+pytestmark = pytest.mark.asyncio
+
+
+class RoutedTest(Base):
+    __tablename__ = 'routed_test'
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(100))
+
+
+class RoutedElement(Base):
+    __tablename__ = 'routed_element'
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    key = sa.Column(sa.String(100))
+
+
+class RoutedPublished(RoutedElement):
+    __tablename__ = 'routed_element_published'
+
+    element_id = sa.Column(
+        sa.ForeignKey('routed_element.id'), primary_key=True)
+    date = sa.Column(sa.DateTime)
+
+
+class Clock:
+    """Stands for the time module on routing, moved by hand"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+def sqlite_url(path, name):
+    url = f"sqlite:///{path / name}.db"
+    engine = sa.create_engine(url)
+    Base.metadata.create_all(engine)
+    # tells apart the database a read went to
+    engine.execute(RoutedTest.__table__.insert().values(id=1, name=name))
+    return url
+
+
+@pytest.fixture
+def urls(tmp_path):
+    return [sqlite_url(tmp_path, name)
+            for name in ("writer", "reader1", "reader2")]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(routing, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def pg_urls(pgsql):
+    # the writer and an empty replica, a read sent to it finds nothing
+    host, port = pgsql
+    urls = [f"postgresql://postgres@{host}:{port}/{name}"
+            for name in ("guillotina", "postgres")]
+    engines = [sa.create_engine(url) for url in urls]
+    for engine in engines:
+        Base.metadata.create_all(engine)
+    yield urls
+    for engine in engines:
+        Base.metadata.drop_all(engine)
+
+
+async def served_by(db):
+    return (await db.query(RoutedTest).get(1)).name
+
+
+async def test_reads_are_balanced_round_robin(urls):
+    db = RoutedDatabase(urls[0], urls[1:])
+    await db.connect()
+    try:
+        assert [await served_by(db) for _ in range(4)] == [
+            "reader1", "reader2", "reader1", "reader2"]
+        assert await db.query(RoutedTest).count() == 1
+
+        await db.add(RoutedTest(id=2, name="new"))
+        assert await db.fetch_val("SELECT count(*) FROM routed_test") == 2
+        for reader in db.readers:
+            assert await reader.fetch_val(
+                "SELECT count(*) FROM routed_test") == 1
+
+        async with db.transaction():
+            assert await served_by(db) == "writer"
+            assert len(await db.query(RoutedTest).all()) == 2
+        assert await served_by(db) in ("reader1", "reader2")
+    finally:
+        await db.disconnect()
+
+
+async def test_least_in_flight(urls):
+    db = RoutedDatabase(urls[0], urls[1:], balance="least_in_flight")
+    await db.connect()
+    try:
+        db.readers[0].in_flight = 5
+        assert [await served_by(db) for _ in range(3)] == ["reader2"] * 3
+        assert db.readers[1].in_flight == 0
+        db.readers[0].in_flight = 0
+
+        served = []
+        async for ins in db.query(RoutedTest):
+            served.append(ins.name)
+            assert sum(r.in_flight for r in db.readers) == 1
+        assert len(served) == 1
+        assert sum(r.in_flight for r in db.readers) == 0
+    finally:
+        await db.disconnect()
+
+    with pytest.raises(ValueError):
+        RoutedDatabase(urls[0], urls[1:], balance="random")
+
+
+async def test_read_your_writes(urls, clock):
+    db = RoutedDatabase(urls[0], urls[1:], read_your_writes=2)
+    await db.connect()
+    try:
+        assert await served_by(db) == "reader1"
+        ins = await db.query(RoutedTest).get(1)
+        ins.name = "updated"
+        await db.update(ins)
+        assert await served_by(db) == "updated"
+        clock.now += 1
+        assert await served_by(db) == "updated"
+        clock.now += 1
+        assert await served_by(db) in ("reader1", "reader2")
+
+        await db.add_all([RoutedTest(id=3, name="bulk")])
+        assert await db.query(RoutedTest).count() == 2
+        clock.now += 2
+        assert await db.query(RoutedTest).count() == 1
+    finally:
+        await db.disconnect()
+
+
+async def test_read_your_inherited_insert(pg_urls, clock):
+    db = RoutedDatabase(pg_urls[0], pg_urls[1:], read_your_writes=2)
+    await db.connect()
+    try:
+        assert db.reader() is db.readers[0]
+        ele = RoutedPublished(key="a")
+        await db.add(ele)
+        assert db.reader() is db
+        res = await db.query(RoutedPublished).get(ele.id)
+        assert res.key == "a"
+
+        clock.now += 2
+        assert db.reader() is db.readers[0]
+        assert await db.query(RoutedPublished).get(ele.id) is None
+    finally:
+        await db.disconnect()
@@ -1,10 +1,12 @@
 
+import io
+import json
 
 import pytest
 from sqlalchemy.ext.declarative import declarative_base
 import sqlalchemy as sa
 from asyncom import OMBase
-from asyncom.utils import import_data
+from asyncom.utils import import_data, iter_yaml
 
 Base = declarative_base(cls=OMBase)
 
@@ -18,6 +20,21 @@ class Data(Base):
     name = sa.Column(sa.String(100), index=True)
 
 
+class DataDefaults(Base):
+    __tablename__ = 'data_importer_defaults'
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    a = sa.Column(sa.String(10), server_default="srv")
+    b = sa.Column(sa.String(10), default="py")
+
+
+class DataKeyed(Base):
+    __tablename__ = 'data_importer_keyed'
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    label = sa.Column("label_name", sa.String(10), key="label")
+
+
 @pytest.fixture
 async def data(async_db):
     url = str(async_db.url)
@@ -49,3 +66,93 @@ async def test_data_loader_from_file(async_db, data):
     await import_data(async_db, 'data_load.yaml', Base)
     res = await async_db.query(Data).get(1)
     assert res.name == "hola"
+
+
+async def test_data_is_imported_from_a_single_line(async_db, data):
+    await import_data(
+        async_db, "[{model: data_importer, data: [{id: 5, name: a}]}]", Base)
+    res = await async_db.query(Data).get(5)
+    assert res.name == "a"
+
+
+async def test_data_is_imported_row_by_row(async_db, data):
+    await import_data(async_db, data_yaml, Base, copy=False)
+    total = await async_db.query(Data).count()
+    assert total == 3
+
+
+async def test_copy_into(async_db, data):
+    rows = [{"id": i, "name": f"name{i}"} for i in range(1, 101)]
+    rows.append(Data(id=101, name="instance"))
+    assert await async_db.copy_into(Data, rows, batch_size=30) == 101
+    assert await async_db.query(Data).count() == 101
+    res = await async_db.query(Data).get(50)
+    assert res.name == "name50"
+    res = await async_db.query(Data).get(101)
+    assert res.name == "instance"
+
+
+async def test_import_reports_stats(async_db, data):
+    stats = await import_data(async_db, data_yaml, Base, batch_size=2)
+    assert stats.tables == {"data_importer": 3}
+    assert stats.rows == 3
+    assert stats.elapsed > 0
+
+
+async def test_import_jsonl(async_db, data):
+    lines = "\n".join(
+        json.dumps({"model": "data_importer", "data": {"id": i, "name": "x"}})
+        for i in range(1, 11))
+    stats = await import_data(async_db, io.StringIO(lines), Base,
+                              format="jsonl", batch_size=3, copy=False)
+    assert stats.rows == 10
+    assert await async_db.query(Data).count() == 10
+
+
+async def test_import_csv(async_db, data):
+    content = "id,name\n1,hola\n2,\n"
+    await import_data(async_db, io.StringIO(content), Base,
+                      format="csv", model="data_importer")
+    res = await async_db.query(Data).get(1)
+    assert res.name == "hola"
+    res = await async_db.query(Data).get(2)
+    assert res.name is None
+
+
+async def test_import_keeps_explicit_nulls(async_db, data):
+    content = """
+- model: data_importer_defaults
+  data:
+    - id: 1
+      a: null
+      b: null
+    - id: 2
+"""
+    for copy in (True, False):
+        await import_data(async_db, content, Base, copy=copy)
+        res = await async_db.query(DataDefaults).get(1)
+        assert (res.a, res.b) == (None, None)
+        res = await async_db.query(DataDefaults).get(2)
+        assert res.a == "srv"
+        await async_db.execute(DataDefaults.__table__.delete())
+
+
+async def test_import_rejects_unknown_columns(async_db, data):
+    content = "[{model: data_importer, data: [{id: 1, nmae: typo}]}]"
+    for copy in (True, False):
+        with pytest.raises(sa.exc.CompileError, match="nmae"):
+            await import_data(async_db, content, Base, copy=copy)
+
+
+async def test_copy_into_columns_named_apart(async_db, data):
+    await async_db.copy_into(DataKeyed, [
+        {"id": 1, "label": "dict"}, DataKeyed(id=2, label="instance")])
+    rows = await async_db.fetch_all(
+        "SELECT label_name FROM data_importer_keyed ORDER BY id")
+    assert [row[0] for row in rows] == ["dict", "instance"]
+
+
+async def test_yaml_is_streamed():
+    rows = iter_yaml(io.StringIO(data_yaml))
+    assert next(rows) == ("data_importer", {"id": 1, "name": "hola"})
+    assert len(list(rows)) == 2
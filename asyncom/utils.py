@@ -1,12 +1,55 @@
-
+import csv
+import datetime
+import json
+import logging
 import sys
+import time
+from collections import OrderedDict
+from io import StringIO
 from os.path import join
 from os.path import dirname
+from os.path import exists
 
 import yaml
 
+from .om import MAX_BIND_PARAMS, copy_rows
+
+logger = logging.getLogger(__name__)
+
+
+class ImportStats:
+    """Rows imported per table, and how long it took"""
+
+    def __init__(self):
+        self.tables = OrderedDict()
+        self.elapsed = 0.0
+        self._started = time.monotonic()
+
+    @property
+    def rows(self):
+        return sum(self.tables.values())
+
+    @property
+    def rows_per_second(self):
+        if not self.elapsed:
+            return 0.0
+        return self.rows / self.elapsed
+
+    def add(self, table, count):
+        self.tables[table] = self.tables.get(table, 0) + count
+
+    def finish(self):
+        self.elapsed = time.monotonic() - self._started
+        return self
+
+    def __str__(self):
+        tables = ", ".join(f"{k}: {v}" for k, v in self.tables.items())
+        return (f"{self.rows} rows in {self.elapsed:.2f}s "
+                f"({self.rows_per_second:.0f} rows/s) [{tables}]")
+
 
-async def import_data(sess, file, base):
+async def import_data(sess, file, base, copy=True, batch_size=1000,
+                      format=None, model=None):
     """ loads data from a fixture file
         format:
         - model: table_name
@@ -15,22 +58,178 @@ async def import_data(sess, file, base):
             prop: value
           - id: 2
             prop: value
+
+        `file` can be a file object, a path or the yaml document itself.
+        Files are parsed as a stream and rows are inserted in batches of
+        up to batch_size rows of the same table, in file order, inside a
+        single transaction, so memory use doesn't depend on the file size.
+
+        Besides yaml, `format` (guessed from the file extension) can be
+        "jsonl", one `{"model": table_name, "data": {...}}` per line, or
+        "csv", rows for the table given with `model`.
+
+        With `copy`, batches are loaded with COPY when sess is an
+        OMDatabase. Returns the ImportStats.
     """
     if hasattr(file, "read"):
-        data = file.read()
+        stream, name = file, getattr(file, "name", "")
+    elif "\n" not in file and _names_file(file):
+        stream, name = open_file(file), file
+    else:
+        stream, name = StringIO(file), ""
+    format = format or _guess_format(name) or "yaml"
+
+    if format == "yaml":
+        rows = iter_yaml(stream)
+    elif format == "jsonl":
+        rows = iter_jsonl(stream)
+    elif format == "csv":
+        if model is None:
+            raise ValueError("csv imports need the model (table) name")
+        rows = iter_csv(stream, model, base)
+    else:
+        raise ValueError(f"Unknown import format {format}")
+
+    stats = ImportStats()
+    current, batch = None, []
+    try:
+        async with sess.transaction():
+            for table_name, row in rows:
+                if batch and (table_name != current or
+                              len(batch) >= batch_size):
+                    await _flush(sess, base, current, batch, copy, stats)
+                    batch = []
+                current = table_name
+                batch.append(row)
+            if batch:
+                await _flush(sess, base, current, batch, copy, stats)
+    finally:
+        if stream is not file:
+            stream.close()
+
+    stats.finish()
+    logger.info("Imported %s", stats)
+    return stats
+
+
+async def _flush(sess, base, table_name, rows, copy, stats):
+    table = base.metadata.tables.get(table_name)
+    if copy and hasattr(sess, "copy_into"):
+        await copy_rows(table, rows, sess)
     else:
-        data = file
-
-    rows = yaml.load(data, Loader=yaml.UnsafeLoader)
-    if isinstance(rows, str):
-        data = load_file(file)
-        rows = yaml.load(data, Loader=yaml.UnsafeLoader)
-
-    for model in rows:
-        Table = base.metadata.tables.get(model['model'])
-        for row in model['data']:
-            stm = Table.insert().values(row)
-            await sess.execute(stm)
+        # multi-row VALUES need the same columns on every row
+        by_columns = OrderedDict()
+        for row in rows:
+            by_columns.setdefault(tuple(row), []).append(row)
+        for columns, values in by_columns.items():
+            size = max(1, MAX_BIND_PARAMS // max(1, len(columns)))
+            for i in range(0, len(values), size):
+                await sess.execute(table.insert().values(values[i:i + size]))
+    stats.add(table_name, len(rows))
+
+
+def iter_yaml(stream, Loader=yaml.UnsafeLoader):
+    """Yields (table name, row) from a fixture document, composing one
+    row at a time instead of loading the whole document"""
+    loader = Loader(stream)
+    try:
+        loader.get_event()  # StreamStart
+        if loader.check_event(yaml.StreamEndEvent):
+            return
+        loader.get_event()  # DocumentStart
+        loader.get_event()  # SequenceStart
+        while not loader.check_event(yaml.SequenceEndEvent):
+            yield from _iter_yaml_model(loader)
+    finally:
+        loader.dispose()
+
+
+def _iter_yaml_model(loader):
+    loader.get_event()  # MappingStart
+    model = None
+    buffered = []
+    while not loader.check_event(yaml.MappingEndEvent):
+        key = loader.construct_object(loader.compose_node(None, None))
+        if key == "model":
+            model = loader.construct_object(loader.compose_node(None, None))
+            for row in buffered:
+                yield model, row
+            buffered = []
+        elif key == "data":
+            loader.get_event()  # SequenceStart
+            while not loader.check_event(yaml.SequenceEndEvent):
+                row = loader.construct_object(
+                    loader.compose_node(None, None), deep=True)
+                # don't keep constructed rows around
+                loader.constructed_objects = {}
+                if model is None:
+                    buffered.append(row)
+                else:
+                    yield model, row
+            loader.get_event()  # SequenceEnd
+        else:
+            loader.compose_node(None, None)
+    loader.get_event()  # MappingEnd
+
+
+def iter_jsonl(stream):
+    for line in stream:
+        line = line.strip()
+        if line:
+            item = json.loads(line)
+            yield item["model"], item["data"]
+
+
+def iter_csv(stream, model, base):
+    table = base.metadata.tables.get(model)
+    converters = {c.name: _csv_converter(c.type) for c in table.columns}
+    for row in csv.DictReader(stream):
+        yield model, {
+            k: None if v == "" else converters[k](v) for k, v in row.items()
+        }
+
+
+def _csv_converter(type_):
+    try:
+        python_type = type_.python_type
+    except NotImplementedError:
+        return str
+    if python_type is bool:
+        return lambda v: v.lower() in ("1", "t", "true", "y", "yes")
+    if python_type in (datetime.datetime, datetime.date, datetime.time):
+        return python_type.fromisoformat
+    if python_type in (dict, list):
+        return json.loads
+    return python_type
+
+
+def _guess_format(name):
+    if name.endswith((".yaml", ".yml")):
+        return "yaml"
+    if name.endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    if name.endswith(".csv"):
+        return "csv"
+    return None
+
+
+def _names_file(text):
+    """Whether a single line given to import_data is a path, and not an
+    inline yaml document"""
+    if exists(text):
+        return True
+    try:
+        return isinstance(yaml.load(text, Loader=yaml.UnsafeLoader), str)
+    except yaml.YAMLError:
+        return False
+
+
+def open_file(file):
+    try:
+        return open(file, "r")
+    except FileNotFoundError:
+        _prefix = sys._getframe(2).f_globals.get('__file__')
+        return open(join(dirname(_prefix), file), 'r')
 
 
 def load_file(file):
@@ -0,0 +1,94 @@
+"""Rows/sec of default_mapper_factory against the per row dict mapper
+it replaced.
+
+    python -m benchmarks.mapper [rows]
+
+Needs `aiosqlite`, rows are loaded once from a sqlite file and mapped
+several times with each factory.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declarative_base
+
+from asyncom import OMBase, OMDatabase
+from asyncom.om import default_mapper_factory, get_prefixes
+
+Base = declarative_base(cls=OMBase)
+
+
+class Row(Base):
+    __tablename__ = "bench_row"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(100))
+    value = sa.Column(sa.Text)
+    amount = sa.Column(sa.Integer)
+    created = sa.Column(sa.DateTime)
+
+
+def dict_mapper_factory(query, context):
+    # mapper used up to 0.3.x, kept here as the baseline
+    entity = query._entity_zero()
+    prefixes = get_prefixes(context.statement._columns_plus_names)
+
+    def map_result(v):
+        return entity.entity(
+            **{prefixes[k]: v for k, v in dict(v).items()})
+    return map_result
+
+
+def measure(query, context, rows, factory, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn = factory(query, context)
+        [fn(r) for r in rows]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(rows) / best
+
+
+async def main(total):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    url = f"sqlite:///{path}"
+    Base.metadata.create_all(sa.create_engine(url))
+    db = OMDatabase(url)
+    await db.connect()
+    try:
+        now = sa.func.current_timestamp()
+        await db.execute(Row.__table__.insert().from_select(
+            ["id", "name", "value", "amount", "created"],
+            sa.select([
+                sa.literal_column("value"),
+                sa.literal("name"),
+                sa.literal("x" * 200),
+                sa.literal_column("value") * 3,
+                now,
+            ]).select_from(sa.text(
+                "(WITH RECURSIVE seq(value) AS (SELECT 1 UNION ALL "
+                f"SELECT value + 1 FROM seq WHERE value < {total}) "
+                "SELECT value FROM seq)"))
+        ))
+        query = db.query(Row)
+        context = query._compile_context()
+        context.statement.use_labels = True
+        rows = await db.fetch_all(query._executable(context))
+
+        before = measure(query, context, rows, dict_mapper_factory)
+        after = measure(query, context, rows, default_mapper_factory)
+        print(f"rows: {len(rows)}")
+        print(f"dict mapper:    {before:12,.0f} rows/sec")
+        print(f"row_mapper:     {after:12,.0f} rows/sec")
+        print(f"speedup:        {after / before:12.2f}x")
+    finally:
+        await db.disconnect()
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000))
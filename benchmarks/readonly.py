@@ -0,0 +1,80 @@
+"""Memory and rows/sec of mapped instances against readonly() records.
+
+    python -m benchmarks.readonly [rows]
+
+Needs `aiosqlite`. Rows (1M by default) are loaded once from a sqlite
+file, then mapped with each factory while tracemalloc measures the memory
+held by the mapped objects (which slows both down, compare rows/sec
+between them only).
+"""
+import asyncio
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import sqlalchemy as sa
+
+from asyncom import OMDatabase
+from asyncom.om import default_mapper_factory
+
+from .mapper import Base, Row
+
+
+def measure(query, context, rows):
+    fn = default_mapper_factory(query, context)
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    mapped = [fn(r) for r in rows]
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del mapped
+    return size, len(rows) / elapsed
+
+
+async def main(total):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    url = f"sqlite:///{path}"
+    Base.metadata.create_all(sa.create_engine(url))
+    db = OMDatabase(url)
+    await db.connect()
+    try:
+        await db.execute(Row.__table__.insert().from_select(
+            ["id", "name", "value", "amount", "created"],
+            sa.select([
+                sa.literal_column("value"),
+                sa.literal("name"),
+                sa.literal("x" * 200),
+                sa.literal_column("value") * 3,
+                sa.func.current_timestamp(),
+            ]).select_from(sa.text(
+                "(WITH RECURSIVE seq(value) AS (SELECT 1 UNION ALL "
+                f"SELECT value + 1 FROM seq WHERE value < {total}) "
+                "SELECT value FROM seq)"))
+        ))
+        query = db.query(Row)
+        context = query._compile_context()
+        context.statement.use_labels = True
+        rows = await db.fetch_all(query._executable(context))
+        # values are decoded on access, keep that out of the measure
+        rows = [tuple(r[i] for i in range(5)) for r in rows]
+
+        size, speed = measure(query, context, rows)
+        ro_size, ro_speed = measure(query.readonly(), context, rows)
+        print(f"rows: {len(rows)}")
+        print(f"instances:  {size / 2 ** 20:10,.1f} MiB "
+              f"{size / len(rows):6.0f} B/row {speed:12,.0f} rows/sec")
+        print(f"readonly(): {ro_size / 2 ** 20:10,.1f} MiB "
+              f"{ro_size / len(rows):6.0f} B/row {ro_speed:12,.0f} rows/sec")
+        print(f"memory:     {size / ro_size:10.2f}x less")
+    finally:
+        await db.disconnect()
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000))
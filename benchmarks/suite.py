@@ -0,0 +1,296 @@
+"""Benchmarks of the asyncom hot paths.
+
+    python -m benchmarks.suite [--url URL] [--rows N] [--only NAME ...]
+                               [--save FILE] [--compare FILE]
+
+Runs on a sqlite file through `aiosqlite` by default, pass a postgres
+`--url` (its tables are created and dropped) to run against it. Each
+benchmark prints operations (rows, gets, inserts...) per second, the best
+of `--repeat` runs, and the memory allocated at its peak from a separate
+run under tracemalloc.
+
+`--save` writes the results as a JSON baseline and `--compare` prints
+the ratio against one, exiting with status 1 when a benchmark is slower
+than the baseline by more than `--tolerance`.
+"""
+import argparse
+import asyncio
+import datetime
+import gc
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declarative_base
+
+from asyncom import OMBase, OMDatabase
+
+Base = declarative_base(cls=OMBase)
+
+
+class Item(Base):
+    __tablename__ = "bench_item"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(100))
+    value = sa.Column(sa.Text)
+    amount = sa.Column(sa.Integer)
+    created = sa.Column(sa.DateTime)
+
+
+class Node(Base):
+    __tablename__ = "bench_node"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(100))
+
+
+class Leaf(Node):
+    __tablename__ = "bench_leaf"
+
+    node_id = sa.Column(sa.ForeignKey("bench_node.id"), primary_key=True)
+    value = sa.Column(sa.Text)
+
+
+BENCHMARKS = {}
+
+_values = itertools.count()
+
+
+def benchmark(name):
+    """Registers fn(db, rows) -> number of operations done"""
+    def register(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return register
+
+
+def _ids(rows, count):
+    step = max(1, rows // count)
+    return list(range(1, rows + 1, step))[:count]
+
+
+@benchmark("get")
+async def bench_get(db, rows):
+    ids = _ids(rows, 1000)
+    for pk in ids:
+        await db.query(Item).get(pk)
+    return len(ids)
+
+
+@benchmark("all_10k")
+async def bench_all_10k(db, rows):
+    return len(await db.query(Item).limit(10000).all())
+
+
+@benchmark("all_100k")
+async def bench_all_100k(db, rows):
+    return len(await db.query(Item).limit(100000).all())
+
+
+@benchmark("iterate")
+async def bench_iterate(db, rows):
+    count = 0
+    async for _ in db.query(Item):
+        count += 1
+    return count
+
+
+@benchmark("iterate_batches")
+async def bench_iterate_batches(db, rows):
+    count = 0
+    async for batch in db.query(Item).iterate_batches(1000):
+        count += len(batch)
+    return count
+
+
+@benchmark("count")
+async def bench_count(db, rows):
+    for _ in range(100):
+        await db.query(Item).filter(Item.amount > 10).count()
+    return 100
+
+
+@benchmark("add")
+async def bench_add(db, rows):
+    for _ in range(1000):
+        await db.add(Item(name="added", value="x" * 50, amount=1))
+    return 1000
+
+
+@benchmark("add_all")
+async def bench_add_all(db, rows):
+    await db.add_all([
+        Item(name="bulk", value="x" * 50, amount=i) for i in range(10000)])
+    return 10000
+
+
+@benchmark("update")
+async def bench_update(db, rows):
+    items = await db.query(Item).filter(Item.id.in_(_ids(rows, 1000))).all()
+    for ins in items:
+        ins.value = str(next(_values))
+        await db.update(ins)
+    return len(items)
+
+
+@benchmark("update_many")
+async def bench_update_many(db, rows):
+    items = await db.query(Item).limit(10000).all()
+    for ins in items:
+        ins.value = str(next(_values))
+    await db.update_many(items)
+    return len(items)
+
+
+@benchmark("inherited_get")
+async def bench_inherited_get(db, rows):
+    ids = _ids(rows // 10, 1000)
+    for pk in ids:
+        await db.query(Leaf).get(pk)
+    return len(ids)
+
+
+@benchmark("inherited_all")
+async def bench_inherited_all(db, rows):
+    return len(await db.query(Leaf).all())
+
+
+@benchmark("inherited_add")
+async def bench_inherited_add(db, rows):
+    for _ in range(1000):
+        await db.add(Leaf(name="added", value="x" * 50))
+    return 1000
+
+
+async def populate(db, rows):
+    now = datetime.datetime.now()
+    await db.copy_into(Item, (
+        {"id": i, "name": f"name{i}", "value": "x" * 200, "amount": i * 3,
+         "created": now}
+        for i in range(1, rows + 1)
+    ))
+    await db.copy_into(Leaf, (
+        {"id": i, "name": f"node{i}", "value": "x" * 50}
+        for i in range(1, rows // 10 + 1)
+    ))
+    if db.dialect.name == "postgresql":
+        # keys were given, move the sequences past them
+        for table in (Item.__table__, Node.__table__):
+            await db.execute(
+                f"SELECT setval('{table.name}_id_seq', "
+                f"(SELECT max(id) FROM {table.name}))")
+
+
+async def measure(db, fn, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        ops = await fn(db, rows)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    gc.collect()
+    tracemalloc.start()
+    await fn(db, rows)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "ops": ops,
+        "ops_per_sec": ops / best,
+        "peak_bytes": peak,
+        "bytes_per_op": peak / ops if ops else 0,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Prints results against baseline, returns the slower names"""
+    slower = []
+    for name, result in results.items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        ratio = result["ops_per_sec"] / base["ops_per_sec"]
+        memory = result["peak_bytes"] / max(base["peak_bytes"], 1)
+        flag = ""
+        if ratio < 1 - tolerance:
+            slower.append(name)
+            flag = "  SLOWER"
+        print(f"{name:16} {ratio:8.2f}x speed {memory:8.2f}x memory{flag}")
+    return slower
+
+
+async def main(args):
+    path = None
+    url = args.url
+    if url is None:
+        path = os.path.join(tempfile.mkdtemp(), "bench.db")
+        url = f"sqlite:///{path}"
+    engine = sa.create_engine(url)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    db = OMDatabase(url, prepared_statements=args.prepared)
+    await db.connect()
+    results = {}
+    try:
+        await populate(db, args.rows)
+        names = args.only or list(BENCHMARKS)
+        for name in names:
+            result = results[name] = await measure(
+                db, BENCHMARKS[name], args.rows, args.repeat)
+            print(f"{name:16} {result['ops']:8} ops "
+                  f"{result['ops_per_sec']:14,.0f} ops/sec "
+                  f"{result['peak_bytes'] / 2 ** 20:10,.2f} MiB peak "
+                  f"{result['bytes_per_op']:10,.0f} B/op")
+    finally:
+        await db.disconnect()
+        Base.metadata.drop_all(engine)
+        if path is not None:
+            os.unlink(path)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "meta": {
+                    "dialect": engine.dialect.name,
+                    "rows": args.rows,
+                    "prepared": args.prepared,
+                    "python": platform.python_version(),
+                    "sqlalchemy": sa.__version__,
+                    "date": datetime.datetime.now().isoformat(),
+                },
+                "results": results,
+            }, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.suite", description=__doc__.split("\n")[0])
+    parser.add_argument("--url", help="database url, a sqlite file if not "
+                                      "given")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS))
+    parser.add_argument("--prepared", type=int, default=0,
+                        help="prepared statements per connection (postgres)")
+    parser.add_argument("--save", help="write the results to a JSON file")
+    parser.add_argument("--compare", help="JSON baseline to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="slowdown flagged as a regression (0.1 = 10%%)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args(sys.argv[1:]))))
@@ -21,6 +21,10 @@ requirements = [
     'databases'
 ]
 
+extras_requirements = {
+    'numpy': ['numpy'],
+}
+
 setup_requirements = ['pytest-runner', ]
 
 test_requirements = [
@@ -41,6 +45,7 @@ setup(
     ],
     description="Small and partial Obejct mapper on top of sqlalchemy for async",
     install_requires=requirements,
+    extras_require=extras_requirements,
     license="MIT license",
     long_description=readme + '\n\n' + history,
     long_description_content_type="text/markdown",